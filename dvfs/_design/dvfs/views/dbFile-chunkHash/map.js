@@ -0,0 +1,4 @@
+function(doc) {
+    if (doc.doc_type == "dbFile" && doc.chunkHash && doc.chunkHash == doc.fileHash)
+        emit(doc.chunkHash, null);
+}
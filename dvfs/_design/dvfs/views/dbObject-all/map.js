@@ -1,4 +1,4 @@
 function(doc) {
     if (doc.doc_type == "dbFile" || doc.doc_type == "dbFolder")
-        emit(doc.path, doc);
+        emit(doc.path, null);
 }
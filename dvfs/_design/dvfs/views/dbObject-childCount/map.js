@@ -0,0 +1,6 @@
+function(doc) {
+    if ((doc.doc_type == "dbFile" || doc.doc_type == "dbFolder") && doc.path != "/") {
+        var slash = doc.path.lastIndexOf('/');
+        emit(slash > 0 ? doc.path.substring(0, slash) : '/', null);
+    }
+}
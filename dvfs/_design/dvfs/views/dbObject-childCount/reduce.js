@@ -0,0 +1 @@
+_count
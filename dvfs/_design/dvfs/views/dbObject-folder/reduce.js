@@ -1,3 +0,0 @@
-function(keys, values, rereduce) {
-    return values;
-}
@@ -0,0 +1,14 @@
+function(doc) {
+    if ((doc.doc_type == "dbFile" || doc.doc_type == "dbFolder") && doc.path != "/") {
+        var slash = doc.path.lastIndexOf('/');
+        var parent = slash > 0 ? doc.path.substring(0, slash) : '/';
+        emit([parent, doc.path.substring(slash + 1)], {
+            doc_type: doc.doc_type,
+            st_mode: doc.st_mode,
+            st_size: doc.st_size,
+            accessTime: doc.accessTime,
+            modifyTime: doc.modifyTime,
+            createTime: doc.createTime
+        });
+    }
+}
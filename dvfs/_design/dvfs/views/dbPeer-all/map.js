@@ -0,0 +1,4 @@
+function(doc) {
+    if (doc.doc_type == "dbPeer")
+        emit(doc.name, {url: doc.url, lastSeen: doc.lastSeen});
+}
@@ -0,0 +1,4 @@
+function(doc) {
+    if (doc.doc_type == "dbRemoteChange")
+        emit([doc.node, doc.time], null);
+}
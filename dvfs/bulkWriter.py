@@ -0,0 +1,245 @@
+"""
+    bulkWriter: Collects metadata changes over a short window and commits them together through _bulk_docs
+"""
+
+import logging
+import threading
+import time
+from uuid import uuid4
+
+from couchdbkit.exceptions import BulkSaveError
+
+from dbConnection import getPipeline
+from dbObjects import dbFile, docClasses
+
+
+class bulkWriter(object):
+    """Batches creates, updates and deletes into as few requests as possible
+        Updates and deletes are looked up with a single keys query per batch. Updates are kept as functions
+        applied to the fetched document, so when a save conflicts the document is fetched again and the
+        functions are replayed on the new revision.
+    """
+    def __init__(self, database, window=0.5, maxDocs=500, retries=3):
+        self.database = database
+        self.window = window
+        self.maxDocs = maxDocs
+        self.retries = retries
+        self.lock = threading.Lock()
+        self.wake = threading.Condition(self.lock)
+        self.flushLock = threading.Lock() #Only one batch is committed at a time
+        self._reset()
+        self.firstChange = None
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name='dvfs-bulk')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _reset(self):
+        self.creates = dict() #path -> (new document, callback run once it's saved)
+        self.updates = dict() #path -> list of functions applied to the document
+        self.deletes = set() #paths
+        self.moved = dict() #current path -> path of the document there when the batch started, for queued moves
+
+    def _changed(self):
+        """Notes a queued change, the caller must hold the lock"""
+        if self.firstChange is None:
+            self.firstChange = time.time()
+            self.wake.notify()
+        if self._pending() >= self.maxDocs:
+            self.wake.notify()
+
+    def _pending(self):
+        return len(self.creates) + len(self.updates) + len(self.deletes)
+
+    def create(self, record, onSaved=None):
+        """Queues a new document (a dbFolder or dbFile with its fields filled in)"""
+        record['_id'] = uuid4().hex
+        with self.lock:
+            self.deletes.discard(record.path)
+            self.creates[record.path] = (record, onSaved)
+            self._changed()
+
+    def update(self, path, change):
+        """Queues change(document) to be applied to the document at path"""
+        with self.lock:
+            if path in self.creates:
+                change(self.creates[path][0])
+            else:
+                self.updates.setdefault(self.moved.get(path, path), []).append(change)
+            self._changed()
+
+    def move(self, old, new):
+        """Queues the document at old to be moved to new"""
+        self.moveAll([(old, new)])
+
+    def moveAll(self, moves):
+        """Queues the documents at each old path to be moved to its new path, all at once so they can swap places
+            moves is a list of (old, new). Later changes to the new paths apply to the moved documents.
+        """
+        with self.lock:
+            moving = []
+            for old, new in moves:
+                created = self.creates.pop(old, None)
+                moving.append((created, None if created else self.moved.pop(old, old), new))
+            for created, origin, new in moving:
+                if created is not None:
+                    created[0].path = new
+                    self.creates[new] = created
+                    continue
+                self.updates.setdefault(origin, []).append(_pathChange(new))
+                if origin != new:
+                    self.moved[new] = origin
+            self._changed()
+
+    def delete(self, path):
+        """Queues the document at path for deletion"""
+        with self.lock:
+            if self.creates.pop(path, None) is not None:
+                return #Never saved, so there's nothing to delete
+            path = self.moved.pop(path, path)
+            self.updates.pop(path, None)
+            self.deletes.add(path)
+            self._changed()
+
+    def _run(self):
+        while True:
+            with self.lock:
+                while self.running and self.firstChange is None:
+                    self.wake.wait()
+                if not self.running:
+                    return
+                remaining = self.firstChange + self.window - time.time()
+                if remaining > 0 and self._pending() < self.maxDocs:
+                    self.wake.wait(remaining)
+                    continue
+            try:
+                self.flush()
+            except Exception:
+                logging.exception("unable to commit a batch of metadata changes")
+
+    def flush(self):
+        """Commits everything queued so far
+            Changes to existing documents go first, so a create lands on its path after whatever moved away from it
+        """
+        with self.flushLock:
+            with self.lock:
+                creates, updates, deletes = self.creates, self.updates, self.deletes
+                self._reset()
+                self.firstChange = None
+
+            self._commitUpdates(updates, deletes)
+            saved = creates.values()
+            docs, replacing = self._replaced(creates)
+            docs.extend(record for record, onSaved in creates.values())
+            self._commit(docs, 'create')
+            self._commitUpdates(replacing, set())
+            for record, onSaved in saved:
+                if onSaved is not None:
+                    onSaved(record)
+
+    def _commitUpdates(self, updates, deletes):
+        """Commits changes to existing documents, fetching and changing them again when their saves conflict"""
+        for attempt in range(self.retries + 1):
+            conflicted = self._commitExisting(updates, deletes)
+            if not conflicted:
+                return
+            updates = dict((path, changes) for path, changes in updates.items() if path in conflicted)
+            deletes = set(path for path in deletes if path in conflicted)
+        logging.error("gave up on conflicting changes to %s" % sorted(conflicted))
+
+    def _replaced(self, creates):
+        """Takes the creates for paths that already have a document of the same kind, such as files the FUSE
+            process saved or fetched itself or a file an editor saved over, out of creates
+            Returns (deletes for documents of the other kind the creates replace, {path: [change]} that gives the
+            existing documents the new objects' attributes), so those documents and their ids are kept.
+        """
+        deletes = []
+        replacing = dict()
+        paths = list(creates)
+        chunks = [paths[start:start + self.maxDocs] for start in range(0, len(paths), self.maxDocs)]
+        for rows in getPipeline().map(self._lookup, chunks):
+            for row in rows:
+                doc = row.get('doc')
+                if not doc or row['key'] not in creates:
+                    continue
+                record, onSaved = creates[row['key']]
+                if docClasses.get(doc['doc_type']) is type(record):
+                    del creates[row['key']]
+                    replacing[row['key']] = [_replacedChange(record)]
+                else:
+                    deletes.append({'_id': doc['_id'], '_rev': doc['_rev'], '_deleted': True})
+        return deletes, replacing
+
+    def _commitExisting(self, updates, deletes):
+        """Fetches, changes and saves existing documents, returning the paths whose saves conflicted"""
+        paths = list(set(updates) | deletes)
+        if not paths:
+            return set()
+        records = dict()
+        chunks = [paths[start:start + self.maxDocs] for start in range(0, len(paths), self.maxDocs)]
+        for rows in getPipeline().map(self._lookup, chunks):
+            for row in rows:
+                if row.get('doc'):
+                    records[row['key']] = docClasses[row['doc']['doc_type']].wrap(row['doc'])
+
+        docs = []
+        idPaths = dict()
+        for path, record in records.items():
+            idPaths[record['_id']] = path
+            if path in deletes:
+                docs.append({'_id': record['_id'], '_rev': record['_rev'], '_deleted': True})
+            else:
+                for change in updates[path]:
+                    change(record)
+                docs.append(record)
+        errors = self._commit(docs, 'update')
+        return set(idPaths[error['id']] for error in errors
+            if error.get('error') == 'conflict' and error.get('id') in idPaths
+        )
+
+    def _lookup(self, paths):
+        return list(self.database.view('dvfs/dbObject-all', keys=paths, include_docs=True))
+
+    def _commit(self, docs, kind):
+        """Saves docs in chunks through _bulk_docs, all chunks at the same time, returning the rows that failed"""
+        errors = []
+        chunks = [docs[start:start + self.maxDocs] for start in range(0, len(docs), self.maxDocs)]
+        for failed in getPipeline().map(self._saveChunk, chunks):
+            errors.extend(failed)
+        for error in errors:
+            if error.get('error') != 'conflict':
+                logging.error("unable to %s %s: %s" % (kind, error.get('id'), error.get('reason')))
+        return errors
+
+    def _saveChunk(self, docs):
+        try:
+            self.database.bulk_save([doc.to_json() if hasattr(doc, 'to_json') else doc for doc in docs], use_uuids=False)
+        except BulkSaveError as error:
+            return error.errors
+        return []
+
+    def stop(self):
+        """Commits what's left and stops the background thread"""
+        with self.lock:
+            self.running = False
+            self.wake.notify_all()
+        self.flush()
+
+
+def _replacedChange(new):
+    """Returns the update that gives an existing document the attributes of the new object replacing it"""
+    fields = ['modifyTime', 'accessTime', 'st_mode', 'node']
+    if isinstance(new, dbFile):
+        fields.extend(['st_size', 'baseMtime', 'baseIno'])
+        if new.fileHash is not None:
+            fields.extend(['fileHash', 'hashType', 'hashSize', 'hashMtime'])
+    def change(record):
+        for field in fields:
+            setattr(record, field, getattr(new, field))
+    return change
+
+
+def _pathChange(path):
+    def change(record):
+        record.path = path
+    return change
@@ -0,0 +1,200 @@
+"""
+    chunkStore: Splits file contents into content defined chunks and keeps them on disk by their hash
+    Chunk boundaries depend only on the bytes around them (a FastCDC style gear hash), so an edit only changes the
+    chunks it touches and identical data in different files or versions is stored once.
+"""
+
+import hashlib
+import logging
+import os
+import struct
+import threading
+import time
+
+defaultMin = 1 << 16
+defaultAvg = 1 << 18
+defaultMax = 1 << 20
+
+#Fixed so every peer cuts the same data at the same places
+_gear = [struct.unpack('>I', hashlib.sha256('dvfs-gear-%d' % value).digest()[:4])[0] for value in range(256)]
+
+
+def _mask(bits):
+    """A mask of the top bits of the 32 bit hash, which depend on the last 32 bytes seen"""
+    return ((1 << bits) - 1) << (32 - bits)
+
+
+class chunker(object):
+    """Splits a stream of data into content defined chunks
+        Normalized chunking: a cut point is harder to hit before avgSize and easier after it, which keeps chunk
+        sizes close to avgSize. The first minSize bytes of each chunk are skipped without hashing.
+    """
+    def __init__(self, minSize=defaultMin, avgSize=defaultAvg, maxSize=defaultMax):
+        self.minSize = minSize
+        self.avgSize = avgSize
+        self.maxSize = maxSize
+        bits = avgSize.bit_length() - 1
+        self.hardMask = _mask(bits + 2)
+        self.easyMask = _mask(bits - 2)
+        self.pending = bytearray()
+        self.position = 0 #How far into pending the hash has got
+        self.hash = 0
+
+    def update(self, data):
+        """Adds data, returning the list of chunks it completed"""
+        self.pending.extend(data)
+        chunks = []
+        while True:
+            cut = self._findCut()
+            if cut is None:
+                return chunks
+            chunks.append(bytes(self.pending[:cut]))
+            del self.pending[:cut]
+            self.position = self.hash = 0
+
+    def finish(self):
+        """Returns the last chunk (None if there's nothing left), after which the chunker starts over"""
+        chunk = bytes(self.pending) if self.pending else None
+        self.pending = bytearray()
+        self.position = self.hash = 0
+        return chunk
+
+    def _findCut(self):
+        """Returns the length of the next chunk in pending, or None if it needs more data"""
+        data = self.pending
+        end = min(len(data), self.maxSize)
+        if end < self.minSize:
+            return None
+        position = max(self.position, self.minSize)
+        value = self.hash
+        gear = _gear
+        for limit, mask in ((min(end, self.avgSize), self.hardMask), (end, self.easyMask)):
+            while position < limit:
+                value = ((value << 1) + gear[data[position]]) & 0xFFFFFFFF
+                position += 1
+                if not value & mask:
+                    return position
+        if end == self.maxSize:
+            return end
+        self.position, self.hash = position, value
+        return None
+
+
+class chunkStore(object):
+    """Chunks stored as files named by their hash, under folder/<first two characters>/"""
+    def __init__(self, folder, algorithm='sha256', minSize=defaultMin, avgSize=defaultAvg, maxSize=defaultMax):
+        self.folder = folder
+        self.algorithm = algorithm
+        self.minSize = minSize
+        self.avgSize = avgSize
+        self.maxSize = maxSize
+        self.lock = threading.Lock()
+        self.storedBytes = 0 #New chunk bytes written since starting
+        self.dedupedBytes = 0 #Chunk bytes that were already stored
+        self.collectedBytes = 0 #Unreferenced chunk bytes removed since starting
+
+    def chunker(self):
+        return chunker(self.minSize, self.avgSize, self.maxSize)
+
+    def path(self, chunkHash):
+        return os.path.join(self.folder, chunkHash[:2], chunkHash)
+
+    def has(self, chunkHash):
+        return os.path.exists(self.path(chunkHash))
+
+    def get(self, chunkHash):
+        """Returns the chunk's data, raises IOError if it isn't stored"""
+        with open(self.path(chunkHash), 'rb') as chunkFile:
+            return chunkFile.read()
+
+    def put(self, data):
+        """Stores data if it isn't already, returning its [hash, size] entry for dbFile.chunks"""
+        chunkHash = hashlib.new(self.algorithm, data).hexdigest()
+        chunkPath = self.path(chunkHash)
+        if os.path.exists(chunkPath):
+            try:
+                os.utime(chunkPath, None) #Used again, so collect leaves it alone until its list is saved
+            except OSError:
+                pass
+            else:
+                with self.lock:
+                    self.dedupedBytes += len(data)
+                return [chunkHash, len(data)]
+        folder = os.path.dirname(chunkPath)
+        if not os.path.isdir(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                pass #Made by another thread in the meantime
+        #Written beside its final name and renamed, so a chunk is never seen half written
+        temporary = '%s.%d.%d.tmp' % (chunkPath, os.getpid(), threading.current_thread().ident)
+        with open(temporary, 'wb') as chunkFile:
+            chunkFile.write(data)
+        os.rename(temporary, chunkPath)
+        with self.lock:
+            self.storedBytes += len(data)
+        return [chunkHash, len(data)]
+
+    def collect(self, referenced, before):
+        """Removes the chunks not in the referenced set of hashes that weren't stored or used since before
+            Chunks stored since then may belong to files whose chunk lists aren't saved yet.
+        """
+        if not os.path.isdir(self.folder):
+            return
+        for folder in os.listdir(self.folder):
+            folderPath = os.path.join(self.folder, folder)
+            if not os.path.isdir(folderPath):
+                continue
+            for name in os.listdir(folderPath):
+                if name in referenced:
+                    continue
+                chunkPath = os.path.join(folderPath, name)
+                try:
+                    info = os.stat(chunkPath)
+                    if info.st_mtime >= before:
+                        continue
+                    os.remove(chunkPath)
+                except OSError:
+                    continue #Removed by another process in the meantime
+                with self.lock:
+                    self.collectedBytes += info.st_size
+
+    def stats(self):
+        with self.lock:
+            return {'storedBytes': self.storedBytes, 'dedupedBytes': self.dedupedBytes,
+                'collectedBytes': self.collectedBytes
+            }
+
+
+class chunkCollector(threading.Thread):
+    """Periodically removes the stored chunks that no current chunk list refers to
+        references is called for the set of chunk hashes still in use, chunks stored or used within the last
+        interval are kept whatever it returns.
+    """
+    def __init__(self, store, references, interval):
+        super(chunkCollector, self).__init__(name='dvfs-chunkgc')
+        self.daemon = True
+        self.store = store
+        self.references = references
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                before = time.time() - self.interval
+                self.store.collect(self.references(), before)
+            except Exception:
+                logging.exception("unable to collect unreferenced chunks")
+
+    def stop(self):
+        self.stopped.set()
+
+
+def openStore(config):
+    """Returns the chunkStore the config describes, or None if chunks aren't stored"""
+    if not config['storeChunks']:
+        return None
+    return chunkStore(config['chunkPath'], config['hashAlgorithm'],
+        config['chunkMin'], config['chunkAvg'], config['chunkMax']
+    )
@@ -0,0 +1,116 @@
+"""
+    dbConnection: The shared CouchDB connection, used by both the FUSE process and the base folder watcher
+    Each process keeps one pool of keep-alive connections and a handle for each database it opened, so getting
+    a database doesn't cost a round trip every time.
+"""
+
+import os
+import random
+import threading
+import time
+
+import couchdbkit as ck
+from couchdbkit.resource import CouchdbResource
+from restkit.conn import Connection
+from restkit.errors import ResourceError, RequestError
+from socketpool import ConnectionPool
+
+from dbPipeline import dbPipeline
+from dvfsConfig import loadConfig
+
+_lock = threading.Lock()
+_config = None #Loaded on first use by callers that don't pass their own
+_servers = dict() #(process id, url) -> ck.Server
+_databases = dict() #(process id, url, database name) -> ck.Database
+_pipelines = dict() #process id -> dbPipeline
+
+
+class retryingResource(CouchdbResource):
+    """Retries reads that fail with a 5xx response or a dropped connection, backing off between attempts
+        Writes aren't retried here since one that failed on the way back may already have been applied,
+        retrying() is used around the whole read-modify-write instead.
+    """
+    retries = 3
+    backoff = 0.2
+
+    def request(self, method, path=None, payload=None, headers=None, **params):
+        params.update(params.pop('params_dict', None) or {}) #restkit's get/put/... pass it, CouchdbResource doesn't take it
+        for attempt in range(self.retries + 1):
+            try:
+                return super(retryingResource, self).request(method, path=path, payload=payload, headers=headers, **params)
+            except (ResourceError, RequestError) as error:
+                if method not in ('GET', 'HEAD') or attempt == self.retries or not _transient(error):
+                    raise
+            _backOff(self.backoff, attempt)
+
+
+def _transient(error):
+    """Returns True for failures worth trying again: server errors and lost connections"""
+    if isinstance(error, RequestError):
+        return True
+    return (getattr(error, 'status_int', None) or 0) >= 500
+
+def _backOff(backoff, attempt):
+    """Sleeps for an exponentially growing, jittered time so retrying clients don't move in lockstep"""
+    time.sleep(backoff * (2 ** attempt) * (0.5 + random.random()))
+
+def retrying(function, retries=None, backoff=None):
+    """Calls function until it succeeds, backing off after conflicts (409) and server errors (5xx)
+        function should fetch the documents it changes itself, so a retry after a conflict starts from the
+        latest revision.
+    """
+    retries = retryingResource.retries if retries is None else retries
+    backoff = retryingResource.backoff if backoff is None else backoff
+    for attempt in range(retries + 1):
+        try:
+            return function()
+        except (ResourceError, RequestError) as error:
+            if attempt == retries or not (isinstance(error, ck.ResourceConflict) or _transient(error)):
+                raise
+        _backOff(backoff, attempt)
+
+def _defaultConfig():
+    global _config
+    if _config is None:
+        _config = loadConfig()
+    return _config
+
+def getServer(config=None):
+    """Returns this process's server, whose connection pool is shared by every database handle"""
+    config = config if config else _defaultConfig()
+    key = (os.getpid(), config['couchUrl']) #A forked process mustn't share its parent's sockets
+    with _lock:
+        server = _servers.get(key)
+        if server is None:
+            retryingResource.retries = config['dbRetries']
+            retryingResource.backoff = config['dbBackoff']
+            pool = ConnectionPool(factory=Connection, max_size=config['dbPoolSize'], backend='thread')
+            server = _servers[key] = ck.Server(config['couchUrl'],
+                resource_class=retryingResource,
+                pool=pool,
+                timeout=config['dbTimeout']
+            )
+        return server
+
+def getDatabase(dbName=None, config=None):
+    """Returns the cached handle of the named database (the configured one by default), creating it if needed"""
+    config = config if config else _defaultConfig()
+    dbName = dbName if dbName else config['dbName']
+    key = (os.getpid(), config['couchUrl'], dbName)
+    with _lock:
+        database = _databases.get(key)
+    if database is None:
+        database = getServer(config).get_or_create_db(dbName)
+        with _lock:
+            database = _databases.setdefault(key, database)
+    return database
+
+def getPipeline(config=None):
+    """Returns this process's pipeline for making independent requests at the same time"""
+    config = config if config else _defaultConfig()
+    key = os.getpid() #Threads don't survive a fork, so a forked process starts its own
+    with _lock:
+        pipeline = _pipelines.get(key)
+        if pipeline is None:
+            pipeline = _pipelines[key] = dbPipeline(config['dbPipelineWorkers'])
+        return pipeline
@@ -3,11 +3,90 @@
     Ben Hartman, 9/10/2015
 """
 import couchdbkit as ck
+from couchdbkit.exceptions import BulkSaveError
+from dbConnection import getDatabase, getPipeline
+import logging
 import os
 from time import mktime
 from stat import S_IFDIR, S_IFREG
 from datetime import datetime
-from hashlib import md5
+
+from fileHasher import hashFile, defaultAlgorithm
+
+
+def iterView(database, viewName, startkey, endkey, pageSize=1000, **params):
+    """Yields the raw rows of a view between startkey and endkey, fetching pageSize rows per request
+        Each page starts from the last key seen rather than an offset, so requests stay cheap deep into large ranges
+    """
+    startDocId = None
+    while True:
+        query = dict(params, startkey=startkey, endkey=endkey, limit=pageSize + 1)
+        if startDocId is not None:
+            query['startkey_docid'] = startDocId
+        rows = list(database.view(viewName, **query))
+        for row in rows[:pageSize]:
+            yield row
+        if len(rows) <= pageSize:
+            return
+        startkey, startDocId = rows[-1]['key'], rows[-1]['id']
+
+def subtreeRows(database, path, pageSize=1000):
+    """Yields the rows, with documents, of everything below path using a key range over the path prefix"""
+    prefix = path.rstrip('/') + '/'
+    return iterView(database, 'dvfs/dbObject-all', prefix, prefix + u'\ufff0', pageSize=pageSize, include_docs=True)
+
+def bulkChange(database, docs, change, chunkSize=500, retries=3):
+    """Applies change to each raw document and saves them in _bulk_docs chunks
+        change can return False to leave a document alone. Documents that conflict are fetched again and changed
+        again, up to retries times.
+    """
+    for attempt in range(retries + 1):
+        docs = [doc for doc in docs if change(doc) is not False]
+        conflicted = []
+        for start in range(0, len(docs), chunkSize):
+            try:
+                database.bulk_save(docs[start:start + chunkSize], use_uuids=False)
+            except BulkSaveError as error:
+                for failure in error.errors:
+                    if failure.get('error') == 'conflict':
+                        conflicted.append(failure['id'])
+                    else:
+                        logging.error("unable to save %s: %s" % (failure.get('id'), failure.get('reason')))
+        if not conflicted:
+            return
+        rows = database.all_docs(keys=conflicted, include_docs=True)
+        docs = [row['doc'] for row in rows if row.get('doc')]
+    logging.error("gave up on conflicting changes to %s" % conflicted)
+
+def childCounts(database, paths):
+    """Returns {folder path: number of objects directly inside it}, counted by the dbObject-childCount view"""
+    counts = dict((path, 0) for path in paths)
+    if counts:
+        for row in database.view('dvfs/dbObject-childCount', keys=list(counts), group=True):
+            counts[row['key']] = row['value']
+    return counts
+
+def _chunks(iterable, size):
+    """Yields lists of up to size items from iterable"""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _deleteChange(doc):
+    doc['_deleted'] = True
+
+def _prefixChange(old, new):
+    """Returns a change moving a document from below old to the same place below new"""
+    def change(doc):
+        if not doc['path'].startswith(old + '/'):
+            return False #Moved or renamed by someone else in the meantime
+        doc['path'] = new + doc['path'][len(old):]
+    return change
 
 class dbObject(ck.Document):
     """Class that all objects will inherit. Used for common fields and settings"""
@@ -16,6 +95,7 @@ class dbObject(ck.Document):
     accessTime = ck.DateTimeProperty()
     path = ck.StringProperty() #contains the full path of the object
     st_mode = ck.IntegerProperty()
+    node = ck.StringProperty() #The node whose base folder holds the object, other nodes fetch its contents
 
     def _getBaseAttributes(self):
         """Sets up base attributes to be added to by children classes
@@ -33,7 +113,7 @@ class dbFolder(dbObject):
         Nothing may need to be added here, the base attributes may be enough
         Identified by the railing slash in the path
     """
-    st_nlink = ck.IntegerProperty()
+    st_nlink = ck.IntegerProperty() #Always 2, the link count reported adds one for each child (see childCounts)
 
     def getAttributes(self):
         """Converts the database version into FUSE ready attributes"""
@@ -42,30 +122,32 @@ class dbFolder(dbObject):
         returnStat['st_nlink'] = self.st_nlink
         return returnStat
 
-    def delete(self):
-        """Since there might be other files and folders underneath this folder we have to handle deleting them before ourselves"""
-        dbView = dbObject()
-        dbView.set_db(self.get_db())
-        children = dbView.view('dvfs/dbObject-folder',
-            key=self.path,
-            classes={'dbFolder':dbFolder, 'dbFile': dbFile}
-        )
-        for child in children:
-            child.delete()
-        basePath = os.path.split(self.path)[0]
-        baseFolder = dbView.view('dvfs/dbObject-all',
-            key=basePath,
-            classes={'dbFolder':dbFolder}
-        ).one()
-        baseFolder.st_nlink -= 1
-        baseFolder.save()
+    def delete(self, chunkSize=500):
+        """Since there might be other files and folders underneath this folder we have to handle deleting them before ourselves
+            Everything below the folder is fetched with one range query and deleted in _bulk_docs chunks, each
+            chunk saved while the next page is fetched
+        """
+        pipeline = getPipeline()
+        pipeline.gather([pipeline.submit(bulkChange, self.get_db(), [row['doc'] for row in rows], _deleteChange, chunkSize)
+            for rows in _chunks(subtreeRows(self.get_db(), self.path, chunkSize), chunkSize)
+        ])
         super(dbFolder, self).delete()
 
-    def createNew(self, dbName, path, mode=False, time=False):
-        """Creates a new folder in the named database"""
-        server = ck.Server()
-        database = server.get_or_create_db(dbName)
-        self.set_db(database)
+    def renameTo(self, path, chunkSize=500):
+        """Moves the folder to path, rewriting the paths of everything below it in _bulk_docs chunks"""
+        old = self.path
+        pipeline = getPipeline()
+        pending = []
+        for rows in _chunks(subtreeRows(self.get_db(), old, chunkSize), chunkSize):
+            #A rewritten document can show up again in a later page if its new path sorts inside the range
+            docs = [row['doc'] for row in rows if row['doc']['path'].startswith(old + '/')]
+            pending.append(pipeline.submit(bulkChange, self.get_db(), docs, _prefixChange(old, path), chunkSize))
+        pipeline.gather(pending)
+        self.path = path
+        self.save()
+
+    def prepareNew(self, path, mode=False, time=False):
+        """Fills in the fields of a new folder without saving it"""
         if not time:
             time = datetime.utcnow()
         self.createTime = self.accessTime = self.modifyTime = time
@@ -74,21 +156,24 @@ class dbFolder(dbObject):
         self.st_mode = mode
         self.st_nlink = 2
         self.path = path
-        self.save()
 
-        dbView = dbFolder()
-        dbView.set_db(database)
-        folPath = os.path.split(path)
-        baseFolder = dbView.view('dvfs/dbFolder-all', key=folPath[0]).one()
-        """There should always be a base folder, if not then there's a problem"""
-        baseFolder.st_nlink += 1
-        baseFolder.save()
+    def createNew(self, dbName, path, mode=False, time=False):
+        """Creates a new folder in the named database"""
+        self.set_db(getDatabase(dbName))
+        self.prepareNew(path, mode, time)
+        self.save()
 
 
 class dbFile(dbObject):
     """The metadata of a stored file"""
     st_size = ck.IntegerProperty() #The size of the file
     fileHash = ck.StringProperty() #File hash, calculated using hashlib. Emptrystring if file is empty
+    hashType = ck.StringProperty() #The hashlib algorithm used for fileHash
+    hashSize = ck.IntegerProperty() #The size of the file when fileHash was calculated
+    hashMtime = ck.FloatProperty() #The base file's modification time when fileHash was calculated
+    baseMtime = ck.FloatProperty() #The base file's modification time when the document was last updated
+    baseIno = ck.IntegerProperty() #The base file's inode number when the document was last updated
+    chunkHash = ck.StringProperty() #The fileHash whose dbChunkList was saved, outdated when they differ
 
 # More fields that may be implemented later
     #oldHash = ck.StringProperty() #Look at older version of record
@@ -102,11 +187,10 @@ class dbFile(dbObject):
         returnStat['st_size'] = self.st_size
         return returnStat
 
-    def createNew(self, dbName, path, basePath=False, mode=False, time=False):
-        """Creates the file in the database"""
-        server = ck.Server()
-        database = server.get_or_create_db(dbName)
-        self.set_db(database)
+    def prepareNew(self, path, basePath=False, mode=False, time=False, algorithm=defaultAlgorithm, hashLater=False):
+        """Fills in the fields of a new file without saving it
+            With hashLater only the size is read, the caller is expected to queue the hash once it's saved
+        """
         self.path = path
         if not time:
             time = datetime.utcnow()
@@ -114,32 +198,104 @@ class dbFile(dbObject):
         if not mode:
             mode = S_IFREG
         self.st_mode = mode
-        if basePath:
-            self.fileHash = md5(basePath).hexdigest()
-            self.st_size = os.path.getsize(basePath)
+        if basePath and hashLater:
+            self.recordStat(os.stat(basePath))
+        elif basePath:
+            self.updateHash(basePath, algorithm)
+
+    def createNew(self, dbName, path, basePath=False, mode=False, time=False, algorithm=defaultAlgorithm, hashPool=None):
+        """Creates the file in the database"""
+        self.set_db(getDatabase(dbName))
+        self.prepareNew(path, basePath, mode, time, algorithm, hashLater=hashPool is not None)
         self.save()
+        if basePath and hashPool is not None:
+            hashPool.submit(path, basePath)
 
-        dbView = dbFolder()
-        dbView.set_db(database)
-        folPath = os.path.split(path)
-        baseFolder = dbView.view('dvfs/dbFolder-all', key=folPath[0]).one()
-        """There should always be a base folder, if not then there's a problem"""
-        baseFolder.st_nlink += 1
-        baseFolder.save()
-
-    def delete(self):
-        """Deletes the file and decrement's it's base folders link list"""
-        dbView = dbFolder()
-        dbView.set_db(self.get_db)
-        basePath = os.path.split(self.path)[0]
-        baseFolder = dbView.view('dvfs/dbObject-all',
-            key=basePath
-        ).one()
-        baseFolder.st_nlink -= 1
-        super(dbFile, self).delete()
-
-    def updateInfo(self, basePath):
-        """Updates the stored information based on the actual base file's information"""
-        self.st_size = os.path.getsize(basePath)
-        self.fileHash = md5(basePath).hexdigest()
+    def updateInfo(self, basePath, algorithm=defaultAlgorithm, fileHash=None, hashPool=None):
+        """Updates the stored information based on the actual base file's information
+            fileHash can be given when the caller already hashed the contents (while they were written)
+            With a hashPool the contents are hashed in the background, which saves fileHash once it's done
+        """
+        if fileHash is None and hashPool is not None:
+            self.recordStat(os.stat(basePath))
+            self.save()
+            if self.hashOutdated(basePath, algorithm) or hashPool.store and self.chunksOutdated():
+                hashPool.submit(self.path, basePath)
+            return
+        self.updateHash(basePath, algorithm, fileHash)
         self.save()
+        if hashPool is not None and hashPool.store and self.chunksOutdated():
+            hashPool.submit(self.path, basePath) #Hashed as it was written, but not chunked yet
+
+    def recordStat(self, info):
+        """Stores the parts of the base file's os.stat result used to notice changes"""
+        self.st_size = info.st_size
+        self.baseMtime = info.st_mtime
+        self.baseIno = info.st_ino
+
+    def statChanged(self, info):
+        """Returns True if the base file's os.stat result differs from the one last recorded"""
+        return (self.st_size, self.baseMtime, self.baseIno) != (info.st_size, info.st_mtime, info.st_ino)
+
+    def hashOutdated(self, basePath, algorithm=defaultAlgorithm):
+        """Returns True if the base file changed since fileHash was calculated"""
+        info = os.stat(basePath)
+        return not (self.hashType == algorithm and self.hashSize == info.st_size and self.hashMtime == info.st_mtime)
+
+    def chunksOutdated(self):
+        """Returns True if no dbChunkList lists the current contents"""
+        return not self.chunkHash or self.chunkHash != self.fileHash
+
+    def updateHash(self, basePath, algorithm=defaultAlgorithm, fileHash=None):
+        """Sets st_size and fileHash from the base file, only reading it if it changed since the last hash"""
+        info = os.stat(basePath)
+        self.recordStat(info)
+        if fileHash is None:
+            if not self.hashOutdated(basePath, algorithm):
+                return
+            fileHash = hashFile(basePath, algorithm)
+        self.fileHash = fileHash
+        self.hashType = algorithm
+        self.hashSize = info.st_size
+        self.hashMtime = info.st_mtime
+
+
+class dbChunkList(ck.Document):
+    """The content defined chunks of one version of a file's contents, shared by every file with that fileHash
+        Kept apart from the dbFile so listings, the snapshot and the changes feed don't carry the chunk lists.
+    """
+    fileHash = ck.StringProperty()
+    hashType = ck.StringProperty()
+    chunks = ck.ListProperty() #[chunk hash, size] of each content defined chunk, in order (see chunkStore)
+
+
+def chunkListId(fileHash):
+    return 'chunks-' + fileHash
+
+def saveChunkList(database, fileHash, hashType, chunks):
+    """Saves the chunk list of fileHash, unless it's already saved"""
+    chunkList = dbChunkList(_id=chunkListId(fileHash), fileHash=fileHash, hashType=hashType, chunks=chunks)
+    try:
+        database.save_doc(chunkList.to_json())
+    except ck.ResourceConflict:
+        pass #The same contents were listed before, by this node or another
+
+def loadChunkList(database, fileHash):
+    """Returns the [hash, size] list of fileHash's chunks, or None if none was saved"""
+    try:
+        return database.open_doc(chunkListId(fileHash)).get('chunks')
+    except ck.ResourceNotFound:
+        return None
+
+def referencedChunks(database, pageSize=1000):
+    """Returns the set of chunk hashes listed for the current contents of any file"""
+    fileHashes = set(row['key'] for row in iterView(database, 'dvfs/dbFile-chunkHash', '', {}, pageSize=pageSize))
+    referenced = set()
+    for batch in _chunks(fileHashes, pageSize):
+        for row in database.all_docs(keys=[chunkListId(fileHash) for fileHash in batch], include_docs=True):
+            if row.get('doc'):
+                referenced.update(chunkHash for chunkHash, size in row['doc'].get('chunks') or [])
+    return referenced
+
+
+docClasses = {'dbFolder': dbFolder, 'dbFile': dbFile} #Maps a document's doc_type to its class
@@ -0,0 +1,97 @@
+"""
+    dbPipeline: Runs independent CouchDB requests at the same time, so an operation needing several of them waits
+    for the slowest one instead of each in turn
+    The requests run on a few threads sharing the pooled connection and the calling thread blocks on the results
+    it needs. A caller waiting on a request no thread has started yet runs it itself, so waiting from inside the
+    pipeline can't deadlock.
+"""
+
+import sys
+import threading
+from collections import deque
+
+
+class pendingResult(object):
+    """The eventual result of a submitted call"""
+    def __init__(self, function, args, kwargs):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.lock = threading.Lock()
+        self.started = False
+        self.finished = threading.Event()
+        self.value = None
+        self.error = None
+
+    def run(self):
+        """Runs the call on this thread, unless another thread already started it"""
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        try:
+            self.value = self.function(*self.args, **self.kwargs)
+        except Exception:
+            self.error = sys.exc_info()
+        finally:
+            self.finished.set()
+
+    def wait(self):
+        self.run()
+        self.finished.wait()
+
+    def result(self):
+        """Waits for the call and returns its value, raising its exception if it failed"""
+        self.wait()
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.value
+
+
+class dbPipeline(object):
+    """A fixed number of threads running submitted calls in submission order"""
+    def __init__(self, workers=8):
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.queue = deque()
+        self.running = True
+        self.threads = []
+        for number in range(workers):
+            thread = threading.Thread(target=self._work, name='dvfs-pipeline-%d' % number)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, function, *args, **kwargs):
+        """Queues function(*args, **kwargs), returning its pendingResult"""
+        pending = pendingResult(function, args, kwargs)
+        with self.lock:
+            if self.running:
+                self.queue.append(pending)
+                self.ready.notify()
+        return pending #Once stopped it's run by whoever waits for it
+
+    def gather(self, pendings):
+        """Waits for all the pending results, returning their values in order or raising the first error"""
+        for pending in pendings:
+            pending.wait()
+        return [pending.result() for pending in pendings]
+
+    def map(self, function, items):
+        """Calls function on every item at the same time, returning the results in order"""
+        return self.gather([self.submit(function, item) for item in items])
+
+    def _work(self):
+        while True:
+            with self.lock:
+                while self.running and not self.queue:
+                    self.ready.wait()
+                if not self.running:
+                    return
+                pending = self.queue.popleft()
+            pending.run()
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+            self.ready.notify_all()
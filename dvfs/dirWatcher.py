@@ -8,17 +8,22 @@ import sys
 import time
 import os
 from datetime import datetime
-from hashlib import md5
 
-import couchdbkit as ck
+from dbConnection import getDatabase
 from dbObjects import dbObject, dbFile, dbFolder
+from dvfsConfig import loadConfig, nodeName
+from hashWorkers import hashPool
+from bulkWriter import bulkWriter
+from eventCoalescer import eventCoalescer
+from chunkStore import openStore
 
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
 
 def startObserver(path='.', database='dvfs'):
-    event_handler = dirWatcher(database)
+    config = loadConfig()
+    event_handler = dirWatcher(database, config, nodeName(config, path), path)
     observer = Observer()
     observer.schedule(event_handler, path, recursive=True)
     observer.start()
@@ -28,56 +33,88 @@ def startObserver(path='.', database='dvfs'):
     except KeyboardInterrupt:
         observer.stop()
     observer.join()
+    event_handler.coalescer.stop()
+    event_handler.writer.stop()
 
 class dirWatcher(FileSystemEventHandler):
-    def __init__(self, dbName=False):
+    def __init__(self, dbName=False, config=None, node=None, base='.'):
+        self.config = config if config else loadConfig()
+        self.node = node
+        self.base = os.path.abspath(base)
         if dbName:
-            server = ck.Server()
-            self.database = server.get_or_create_db(dbName)
+            self.database = getDatabase(dbName, self.config)
             self.dataOb = dbObject.set_db(self.database)
             self.dbName = dbName
+            self.hashPool = None
+            if self.config['hashWorkers'] > 0:
+                self.hashPool = hashPool(self.database, self.config['hashWorkers'], self.config['hashAlgorithm'],
+                    openStore(self.config)
+                )
+            self.writer = bulkWriter(self.database, self.config['bulkWindow'], self.config['bulkSize'])
+            self.coalescer = eventCoalescer(self, self.config['quietPeriod'], self.config['maxHold'])
         return super(dirWatcher, self).__init__()
 
+    def dvfsPath(self, basePath):
+        """Returns the dvfs path of a path inside the base folder, whether the base was given relative or absolute"""
+        path = os.path.relpath(os.path.abspath(basePath), self.base)
+        return '/' if path == '.' else '/' + path
+
     def on_created(self, event):
-        path = "/" + "/".join(event.src_path.split('/')[1:])
-        if event.is_directory:
-            info = dbFolder()
-        else:
-            info = dbFile()
-        info.createNew(self.dbName, path, event.src_path)
+        self.coalescer.created(self.dvfsPath(event.src_path), event.is_directory, event.src_path)
     def on_deleted(self, event):
-        path = "/" + "/".join(event.src_path.split('/')[1:])
-        dbView = dbObject(self.dataOb)
-        info = dbView.view('dvfs/dbObject-all',
-            key=path,
-            classes={'dbFolder':dbFolder, 'dbFile': dbFile}
-        ).one()
-        if info:
-            info.delete()
+        self.coalescer.deleted(self.dvfsPath(event.src_path), event.is_directory, event.src_path)
     def on_modified(self, event):
-        path = "/" + "/".join(event.src_path.split('/')[1:])
-        if event.is_directory:
-            dbView = dbFolder(self.dataOb)
-        else:
-            dbView = dbFile(self.dataOb)
-        info = dbView.view('dvfs/dbObject-all',
-            key=path
-        ).one()
-        info.modifyTime = info.accessTime = datetime.utcnow()
-        if not event.is_directory:
-            info.st_size = os.path.getsize(event.src_path)
-            info.fileHash = md5(event.src_path).hexdigest()
-        info.save()
+        self.coalescer.modified(self.dvfsPath(event.src_path), event.is_directory, event.src_path)
     def on_moved(self, event):
-        srcPath = "/" + "/".join(event.src_path.split('/')[1:])
-        destPath = "/" + "/".join(event.dest_path.split('/')[1:])
-        dbView = dbObject(self.dataOb)
-        record = dbView.view('dvfs/dbObject-all',
-            key=srcPath,
-            classes={'dbFolder':dbFolder, 'dbFile': dbFile}
-        ).one()
-        record.path = destPath
-        record.save()
+        srcPath = self.dvfsPath(event.src_path)
+        destPath = self.dvfsPath(event.dest_path)
+        self.coalescer.moved(srcPath, destPath, event.is_directory, event.dest_path)
+
+    """The net changes, once the coalescer has folded the events for a path together"""
+    def applyCreated(self, path, directory, basePath):
+        if directory:
+            info = dbFolder()
+            info.prepareNew(path)
+            info.node = self.node
+            self.writer.create(info)
+        else:
+            info = dbFile()
+            try:
+                info.prepareNew(path, basePath,
+                    algorithm=self.config['hashAlgorithm'],
+                    hashLater=self.hashPool is not None
+                )
+            except OSError:
+                return #Already gone again, a delete event will follow
+            info.node = self.node
+            onSaved = None
+            if self.hashPool:
+                onSaved = lambda record: self.hashPool.submit(record.path, basePath)
+            self.writer.create(info, onSaved)
+    def applyDeleted(self, path):
+        self.writer.delete(path)
+    def applyModified(self, path, basePath):
+        self.writer.update(path, self._modifiedChange(basePath, datetime.utcnow()))
+    def applyMoves(self, moves):
+        self.writer.moveAll(moves)
+
+    def _modifiedChange(self, basePath, time):
+        """Returns the update applied to a modified object's document once the batch is committed"""
+        def change(record):
+            record.modifyTime = record.accessTime = time
+            record.node = self.node
+            if not isinstance(record, dbFile):
+                return
+            try:
+                if self.hashPool is None:
+                    record.updateHash(basePath, self.config['hashAlgorithm'])
+                    return
+                record.recordStat(os.stat(basePath))
+                if record.hashOutdated(basePath, self.config['hashAlgorithm']):
+                    self.hashPool.submit(record.path, basePath)
+            except OSError:
+                pass #Deleted since, the delete event takes care of it
+        return change
 
 if __name__ == "__main__":
     print("running from the command line")
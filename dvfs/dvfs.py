@@ -5,56 +5,172 @@
 """
 
 import logging
+import threading
+from functools import wraps
 import argparse #For easy parsing of the command line arguments
 from multiprocessing import Process
 
-from string import split
 from unicodedata import normalize
-from errno import ENOENT
-from stat import S_IFDIR, S_IFLNK, S_IFREG #Handle links in some fashion
+from errno import ENOENT, EBADF, EIO, ENOTEMPTY
+from stat import S_IFDIR, S_IFLNK, S_IFREG, S_ISDIR #Handle links in some fashion
 from datetime import datetime
-from hashlib import md5
 
 from fuse import FUSE, FuseOSError, Operations, LoggingMixIn
 
-import couchdbkit as ck
 import os
 
-from dbObjects import dbObject, dbFile, dbFolder
+from dbConnection import getDatabase, getPipeline, retrying
+from dbObjects import dbObject, dbFile, dbFolder, iterView, childCounts, referencedChunks
+from metaCache import metaCache, changeFollower
+from dvfsConfig import loadConfig, nodeName
+from fileHandles import handleTable, dirtyFlusher
+from hashWorkers import hashPool
+from bulkWriter import bulkWriter
+from reconcile import reconciler
+from metaSnapshot import metaSnapshot
+from metaRecord import metaRecord
+from pathLocks import pathLocks
+from chunkStore import openStore, chunkCollector
+from transfer import chunkServer, peerRegistry, transferEngine
+from hydration import hydrationCache
+from readAhead import prefetchPool
+from remoteChanges import remoteChangeApplier, recordRemoteChange, knownNodes
+
+
+def _lockingPaths(count=1):
+    """Runs a metadata changing operation while holding the locks of its first count arguments, which are paths
+        Operations on other paths carry on in parallel when fuse runs multithreaded
+    """
+    def decorator(operation):
+        @wraps(operation)
+        def locked(self, *args, **kwargs):
+            with self.pathLocks.hold(*args[:count]):
+                return operation(self, *args, **kwargs)
+        return locked
+    return decorator
 
 
-def _addBaseNlink(dataOb, path, amount):
-    """Adds amount to the base folder of path, works for both adding and subtracting"""
-    dbView = dbFolder(dataOb)
-    basePath = os.path.dirname(path)
-    basePath = basePath if not basePath == '' else '/'
-    baseFolder = dbView.view('dvfs/dbFolder-all', key=basePath).one()
-    baseFolder.st_nlink += amount
-    baseFolder.save()
-    return baseFolder.st_nlink
-
 class dvfs(LoggingMixIn, Operations):
     """Represents a filesystem overlayed with metadata contents from a CouchDB database"""
-    def __init__(self, base, debug):
-        self.fd = 0
-
+    def __init__(self, base, debug, config=None):
         """dvfs stuff"""
         self.debug = debug
+        self.config = config if config else loadConfig()
+        self.prefetcher = None
+        if self.config['readAheadMax'] > 0:
+            self.prefetcher = prefetchPool(self.config['readAheadWorkers'],
+                self.config['readAheadMin'], self.config['readAheadMax']
+            )
+        self.handles = handleTable(self.prefetcher, self.config['writeBufferSize'])
+        self.pathLocks = pathLocks()
         if base[0] == '/':
             self.base = base
         else:
             self.base = os.path.dirname(os.path.realpath(__file__)) + "/" + base
-        self.connectDatabase(dbName='dvfs')
+        self.node = nodeName(self.config, self.base)
+        self.cache = metaCache(self.config['cacheSize'], self.config['cacheTTL'],
+            self.config['missingCacheSize'], self.config['missingCacheTTL']
+        )
+        self.follower = None
+        self.snapshot = None
+        self.flusher = None
+        self.chunkCollector = None
+        self.hashPool = None
+        self.chunkStore = openStore(self.config)
+        self.chunkServer = None
+        self.peers = None
+        self.transfers = None
+        self.hydration = None
+        self.remoteChanges = None
+        self.connectDatabase(dbName=self.config['dbName'])
 
     def connectDatabase(self, dbName):
         """Sets up the database to be interacted"""
         if self.debug == True:
             logging.debug("connecting to database")
-        server = ck.Server()
-        self.database = server.get_or_create_db(dbName)
+        self.database = getDatabase(dbName, self.config)
         self.dataOb = dbObject.set_db(self.database)
         self.dbName = dbName
 
+    def init(self, path):
+        """Called by fuse once mounted (and daemonized), starts following the database's changes"""
+        if self.debug == True:
+            logging.debug("in init")
+        listeners = []
+        since = None
+        if self.config['useSnapshot']:
+            #Opened here rather than in __init__ since fuse forks when it daemonizes
+            self.snapshot = metaSnapshot(self.config['snapshotPath'])
+            listeners.append(self.snapshot)
+            if self.snapshot.complete:
+                since = self.snapshot.since
+            else:
+                self.snapshot.clear()
+        if since is None:
+            since = self.database.info()['update_seq']
+        #After the snapshot, so a lookup the cache misses because of a change finds that change in the snapshot
+        listeners.append(self.cache)
+        self.remoteChanges = remoteChangeApplier(self.base, self.database, self.node, self._remoteChangeApplied)
+        listeners.append(self.remoteChanges)
+        self.follower = changeFollower(self.database, listeners, since=since)
+        self.follower.start()
+        if self.snapshot and not self.snapshot.complete:
+            loader = threading.Thread(target=self.snapshot.load,
+                args=(self.database, since, self.config['listPageSize']),
+                name='dvfs-snapshot'
+            )
+            loader.daemon = True
+            loader.start()
+        if self.config['hashWorkers'] > 0:
+            self.hashPool = hashPool(self.database, self.config['hashWorkers'], self.config['hashAlgorithm'], self.chunkStore)
+        if self.config['reconcileOnMount']:
+            loader = threading.Thread(target=self._loadFolder, name='dvfs-reconcile')
+        else:
+            loader = threading.Thread(target=self._applyRemoteChanges, name='dvfs-remote')
+        loader.daemon = True
+        loader.start()
+        if self.config['metaFlushInterval'] > 0:
+            self.flusher = dirtyFlusher(self.handles, self._flushMetadata, self.config['metaFlushInterval'])
+            self.flusher.start()
+        if self.chunkStore and self.config['chunkGcInterval'] > 0:
+            self.chunkCollector = chunkCollector(self.chunkStore,
+                lambda: referencedChunks(self.database, self.config['listPageSize']), self.config['chunkGcInterval']
+            )
+            self.chunkCollector.start()
+        if self.config['transfer'] and not self.config['transferSecret']:
+            logging.warning("transferSecret isn't set, so file contents aren't served to or fetched from peers")
+        elif self.config['transfer']:
+            self.chunkServer = chunkServer(self.chunkStore, self.base, self.database, self.node,
+                self.config['transferSecret'], self.config['transferHost'], self.config['transferPort']
+            )
+            self.peers = peerRegistry(self.database, self.node, self.chunkServer.url, self.config['peerTTL'])
+            self.peers.start()
+            self.transfers = transferEngine(self.peers, self.config['transferSecret'], self.chunkStore, self.config['partialPath'],
+                self.config['transferWorkers'], self.config['transferTimeout']
+            )
+            self.hydration = hydrationCache(self.config['hydratePath'], self.transfers, self.config['hydrateMaxBytes'])
+
+    def destroy(self, path):
+        """Called by fuse while unmounting"""
+        if self.debug == True:
+            logging.debug("in destroy, cache stats: %s" % self.cache.stats())
+        if self.follower:
+            self.follower.stop()
+        if self.flusher:
+            self.flusher.stop()
+        if self.chunkCollector:
+            self.chunkCollector.stop()
+        if self.hashPool:
+            self.hashPool.stop()
+        if self.peers:
+            self.peers.stop()
+        if self.chunkServer:
+            self.chunkServer.stop()
+        if self.prefetcher:
+            self.prefetcher.stop()
+        if self.snapshot:
+            self.snapshot.close()
+
     def chmod(self, path, mode):
         """Changes the mode of an object, not implemented"""
         if self.debug == True:
@@ -67,46 +183,99 @@ class dvfs(LoggingMixIn, Operations):
             logging.debug("in chown")
         pass
 
-    def create(self, path, mode):
-        """Create the filesystem file"""
+    @_lockingPaths()
+    def create(self, path, mode, fi=None):
+        """Create the filesystem file, returning an open handle to it"""
         if self.debug == True:
             logging.debug("in create")
         fullPath = self.base + path
-        openFile = open(fullPath, 'w+')
-        openFile.close()
+        self._ensureParent(path)
+        try:
+            fh = self.handles.open(path, fullPath, os.O_RDWR | os.O_CREAT | os.O_TRUNC, mode,
+                self.config['hashAlgorithm']
+            )
+        except OSError as error:
+            raise FuseOSError(error.errno)
 
         newFile = dbFile(self.dataOb)
-        fullPath = self.base + path
-        newFile.createNew(self.dbName, path, basePath=fullPath)
-
-        """Increment the base folder's file descriptor count and return it"""
-        return _addBaseNlink(self.dataOb, path, 1)
+        newFile.node = self.node
+        newFile.createNew(self.dbName, path, basePath=fullPath, algorithm=self.config['hashAlgorithm'])
+        if self.snapshot:
+            self.snapshot.put(path, newFile.getAttributes(), newFile._id)
+        self.cache.evict(path)
+        self.cache.evict(os.path.dirname(path))
+        return fh
 
     def getattr(self, path, fh=None):
         """Handles file/folder attributes (number of links, size, etc.)"""
         if self.debug == True:
             logging.debug("in getattr")
-        dbView = dbObject(self.dataOb)
-        try:
-            info = dbView.view('dvfs/dbObject-all',
-                key=path,
-                classes={'dbFolder':dbFolder, 'dbFile': dbFile}
-            ).one()
-        except:
+        record = self.cache.get(path)
+        if record is not None:
+            return self._withUnsavedSize(path, record.attributes())
+        if self.cache.isMissing(path):
             raise FuseOSError(ENOENT)
 
-        #If everything goes fine, but there isn't a record stored
-        if not info:
-            raise FuseOSError(ENOENT)
+        generation = self.cache.generation
+        stored = self.snapshot.get(path) if self.snapshot else None
+        if stored is not None:
+            attributes, docId = stored
+            record = metaRecord.fromAttributes(attributes, docId)
+        else:
+            try:
+                #The raw row, wrapping it in a document isn't needed for its attributes
+                row = self.database.view('dvfs/dbObject-all', key=path, include_docs=True).one()
+            except:
+                raise FuseOSError(ENOENT)
+
+            #If everything goes fine, but there isn't a record stored
+            if not row:
+                self.cache.putMissing(path, generation)
+                raise FuseOSError(ENOENT)
+            record = metaRecord.fromDoc(row['doc'])
+
+        self._countLinks({path: record})
+        self.cache.put(path, record, generation)
+        return self._withUnsavedSize(path, record.attributes())
+
+    def _countLinks(self, folders):
+        """Sets the nlink of the folders among {path: metaRecord} to 2 plus the number of objects inside them
+            Counting keeps creates and deletes from having to update the parent folder's document
+        """
+        folders = dict((path, record) for path, record in folders.items() if S_ISDIR(record.mode))
+        if not folders:
+            return
+        if self.snapshot and self.snapshot.complete:
+            counts = self.snapshot.childCounts(folders)
+        else:
+            counts = childCounts(self.database, folders)
+        for path, record in folders.items():
+            record.nlink = 2 + counts[path]
 
-        return info.getAttributes()
+    def _withUnsavedSize(self, path, attributes):
+        """Reports the size of files written through open handles, since their documents are only saved later"""
+        size = self.handles.dirtySize(path)
+        if size is not None:
+            attributes['st_size'] = size
+        return attributes
 
     def getxattr(self, path, name, position=0):
         if self.debug == True:
             logging.debug("in getxattr")
+        if path == '/' and name == 'user.dvfs.cacheStats':
+            return str(self.cache.stats())
+        if path == '/' and name == 'user.dvfs.hashStats':
+            return str(self.hashPool.stats() if self.hashPool else {})
+        if path == '/' and name == 'user.dvfs.transferStats':
+            return str(self.transfers.stats() if self.transfers else {})
+        if path == '/' and name == 'user.dvfs.hydrationStats':
+            return str(self.hydration.stats() if self.hydration else {})
+        if path == '/' and name == 'user.dvfs.readAheadStats':
+            return str(self.prefetcher.stats() if self.prefetcher else {})
         dbView = dbObject(self.dataOb)
         info = dbView.view('dvfs/dbObject-all',
             key=path,
+            include_docs=True,
             classes={'dbFolder':dbFolder, 'dbFile': dbFile}
         ).one()
 
@@ -124,17 +293,19 @@ class dvfs(LoggingMixIn, Operations):
         dbView = dbObject(self.dataOb)
         info = dbView.view('dvfs/dbObject-all',
             key=path,
+            include_docs=True,
             classes={'dbFolder':dbFolder, 'dbFile': dbFile}
         ).one()
         attrs = info.getAttributes().get('attrs', {})
         return attrs.keys()
 
+    @_lockingPaths()
     def mkdir(self, path, mode):
         """Create a filesystem folder"""
         if self.debug == True:
             logging.debug("in mkdir")
         fullPath = self.base + path
-        os.makedirs(fullPath)
+        os.makedirs(fullPath) #Along with any parents only other nodes held so far
 
         """Create the CouchDB metadata"""
         newFolder = dbFolder()
@@ -143,57 +314,210 @@ class dvfs(LoggingMixIn, Operations):
         newFolder.createTime = newFolder.accessTime = newFolder.modifyTime = datetime.utcnow()
         newFolder.st_mode = (S_IFDIR | mode)
         newFolder.st_nlink = 2
+        newFolder.node = self.node
         newFolder.save()
-        _addBaseNlink(self.dataOb, path, 1)
+        if self.snapshot:
+            self.snapshot.put(path, newFolder.getAttributes(), newFolder._id)
+        self.cache.evict(path)
+        self.cache.evict(os.path.dirname(path))
 
     def open(self, path, flags):
-        """Opens a file object"""
+        """Opens the base file, returning the handle fuse passes to read/write/release"""
         if self.debug == True:
             logging.debug("in open")
-        self.fd += 1
-        return self.fd
+        if not os.path.exists(self.base + path):
+            if not flags & (os.O_WRONLY | os.O_RDWR):
+                return self._openRemote(path, flags)
+            self._fetch(path)
+        try:
+            return self.handles.open(path, self.base + path, flags, hashAlgorithm=self.config['hashAlgorithm'])
+        except OSError as error:
+            raise FuseOSError(error.errno)
+
+    def _openRemote(self, path, flags):
+        """Opens a hydrated copy of a file other nodes hold, whose reads wait for the bytes they need to arrive"""
+        info = self._lookup(path)
+        if not isinstance(info, dbFile):
+            raise FuseOSError(ENOENT)
+        if self.hydration is None:
+            raise FuseOSError(EIO)
+        try:
+            hydrated, fd = self.hydration.open(info)
+        except (IOError, OSError) as error:
+            logging.error("unable to fetch %s: %s" % (path, error))
+            raise FuseOSError(EIO)
+        return self.handles.add(path, fd, flags, hydrated.waitFor, lambda: self.hydration.release(hydrated))
+
+    def _fetch(self, path):
+        """Fetches the contents of a file that's in the database but not in the base folder into it, to change them
+            From then on this node holds the file.
+        """
+        with self.pathLocks.hold(path):
+            if os.path.exists(self.base + path):
+                return #Fetched by another thread while this one waited
+            info = self._lookup(path)
+            if not isinstance(info, dbFile):
+                raise FuseOSError(ENOENT)
+            if self.transfers is None:
+                raise FuseOSError(EIO)
+            try:
+                partial = self.transfers.partialFor(info)
+                if self.hydration and self.hydration.copyTo(info, partial):
+                    self.transfers.place(partial, self.base + path)
+                else:
+                    self.transfers.fetch(info, self.base + path)
+            except (IOError, OSError) as error:
+                logging.error("unable to fetch %s: %s" % (path, error))
+                raise FuseOSError(EIO)
+
+    def _ensureParent(self, path):
+        """Makes the base folder of path, for folders that so far only exist on other nodes"""
+        folder = self.base + os.path.dirname(path)
+        if not os.path.isdir(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                pass #Made by another thread in the meantime
+
+    def _getHandle(self, fh):
+        """Returns the open handle for fh"""
+        handle = self.handles.get(fh)
+        if handle is None:
+            raise FuseOSError(EBADF)
+        return handle
 
     def read(self, path, size, offset, fh):
         """Reads in data from a file"""
         if self.debug == True:
             logging.debug("in read")
-        fullPath = self.base + path
-        with open(fullPath, 'r') as f:
-            f.seek(offset)
-            value = f.read(size)
-        return value
+        handle = self._getHandle(fh)
+        try:
+            self.handles.flushWrites(handle.path) #Reads see the writes still collected by any handle
+            return handle.read(size, offset)
+        except (IOError, OSError) as error:
+            raise FuseOSError(error.errno or EIO) #Like a remote file whose fetch failed
+
+    def flush(self, path, fh):
+        """Called on every close of a handle, saves any metadata the writes left pending"""
+        if self.debug == True:
+            logging.debug("in flush")
+        handle = self._getHandle(fh)
+        try:
+            handle.flushWrites()
+        except (IOError, OSError) as error:
+            raise FuseOSError(error.errno or EIO) #Reported on close, like any other write back cache
+        self._flushMetadata(handle)
+        return 0
+
+    def fsync(self, path, datasync, fh):
+        """Syncs the base file to disk along with its metadata"""
+        if self.debug == True:
+            logging.debug("in fsync")
+        handle = self._getHandle(fh)
+        try:
+            handle.fsync(datasync)
+        except (IOError, OSError) as error:
+            raise FuseOSError(error.errno or EIO)
+        self._flushMetadata(handle)
+        return 0
+
+    def release(self, path, fh):
+        """Closes the handle once the last reference to it is closed"""
+        if self.debug == True:
+            logging.debug("in release")
+        handle = self.handles.get(fh)
+        try:
+            if handle is not None:
+                self._flushMetadata(handle)
+        finally:
+            self.handles.release(fh)
+        return 0
+
+    def _flushMetadata(self, handle):
+        """Saves the size and hash of a file changed through handle into its dbFile document, if there are changes"""
+        handle.flushWrites() #The document is updated from the base file's size
+        if not handle.takeDirty():
+            return
+        path = handle.path
+        dbView = dbFile(self.dataOb)
+        fileHash = handle.hasher.hexdigest(handle.size) if handle.hasher else None
+        def save():
+            info = dbView.view('dvfs/dbFile-all', key=path, include_docs=True).one()
+            if info is None:
+                raise FuseOSError(ENOENT) #Deleted while it was open, so there's nothing left to save
+            info.node = self.node
+            info.updateInfo(self.base + path, self.config['hashAlgorithm'], fileHash, self.hashPool)
+        try:
+            with self.pathLocks.hold(path):
+                retrying(save) #The hash workers save the same documents
+        except FuseOSError:
+            raise
+        except Exception:
+            if self.debug == True:
+                logging.debug("unable to save the metadata of %s" % path)
+            handle.markDirty() #Saved again by the next flush
+            raise FuseOSError(EIO) #The database couldn't be reached or refused the save
+        self.cache.evict(path)
 
     def readdir(self, path, fh):
-        """Returns a directory's contents"""
+        """Returns a directory's contents, caching each child's attributes along the way"""
         if self.debug == True:
             logging.debug("in readir")
-        dbView = dbObject(self.dataOb)
-        documents = dbView.view('dvfs/dbObject-folder',
-            key=path,
-            classes={'dbFolder': dbFolder, 'dbFile': dbFile}
-        ).all()[0]['value']
-
-        def mapPath(documentId):
-            path = split(dbView.get(documentId).path, '/')[-1:][0]
-            if type(path) is unicode:
-                path = normalize('NFKD', path).encode('ascii', 'ignore')
-            if path == '':
-                return []
-            return [path]
-
-        def reducePaths(*args):
-            paths = []
-            for arg in args:
-                paths.extend(arg)
+        generation = self.cache.generation
+        if self.snapshot and self.snapshot.complete:
+            paths = ['.', '..']
+            children = [(name, metaRecord.fromAttributes(attributes, docId))
+                for name, attributes, docId in self.snapshot.children(path)
+            ]
+            self._countLinks(dict((os.path.join(path, name), record) for name, record in children))
+            for name, record in children:
+                self.cache.put(os.path.join(path, name), record, generation)
+                if type(name) is unicode:
+                    name = normalize('NFKD', name).encode('ascii', 'ignore')
+                if name != '':
+                    paths.append(name)
             return paths
 
-        paths = reduce(
-            reducePaths,
-            map(mapPath, documents),
-            ['.', '..']
+        rows = iterView(self.database, 'dvfs/dbObject-parent',
+            [path],
+            [path, {}],
+            pageSize=self.config['listPageSize']
         )
+
+        paths = ['.', '..']
+        pipeline = getPipeline(self.config)
+        pending = []
+        page = []
+        for row in rows:
+            name = row['key'][1]
+            page.append((os.path.join(path, name), metaRecord.fromDoc(row['value'], row['id'])))
+            if len(page) >= self.config['listPageSize']:
+                #Counted and cached while the next page is fetched
+                pending.append(pipeline.submit(self._cacheChildren, page, generation))
+                page = []
+            if type(name) is unicode:
+                name = normalize('NFKD', name).encode('ascii', 'ignore')
+            if name != '':
+                paths.append(name)
+        pending.append(pipeline.submit(self._cacheChildren, page, generation))
+        pipeline.gather(pending)
         return paths
 
+    def _cacheChildren(self, children, generation):
+        """Caches a list of (path, metaRecord), counting the folders' links with one query"""
+        self._countLinks(dict(children))
+        for childPath, record in children:
+            self.cache.put(childPath, record, generation)
+
+    def _lookup(self, path):
+        """Fetches the document at path, None if there isn't one"""
+        dbView = dbObject(self.dataOb)
+        return dbView.view('dvfs/dbObject-all',
+            key=path,
+            include_docs=True,
+            classes={'dbFolder':dbFolder, 'dbFile': dbFile}
+        ).one()
+
     def readlink(self, path):
         """This would be nice to have implemented, but it's not necessary"""
         if self.debug == True:
@@ -201,6 +525,7 @@ class dvfs(LoggingMixIn, Operations):
         raise FuseOSError(ENOENT)
         #return self.data[path]
 
+    @_lockingPaths()
     def removexattr(self, path, name):
         """Removes a particular extended attribute"""
         if self.debug == True:
@@ -208,45 +533,73 @@ class dvfs(LoggingMixIn, Operations):
         dbView = dbObject(self.dataOb)
         couchOb = dbView.view('dvfs/dbObject-all',
             key=path,
+            include_docs=True,
             classes={'dbFolder':dbFolder, 'dbFile': dbFile}
         ).one()
         del couchOb[name]
         couchOb.save()
+        self.cache.evict(path)
 
+    @_lockingPaths(2)
     def rename(self, old, new):
         """Update the metadata"""
         if self.debug == True:
             logging.debug("in rename")
-        dbView = dbObject(self.dataOb)
-        couchOb = dbView.view('dvfs/dbObject-all',
-            key=old,
-            classes={'dbFolder':dbFolder, 'dbFile': dbFile}
-        ).one()
-        couchOb.path = new
-        couchOb.save()
-        _addBaseNlink(self.dataOb, old, -1)
-        _addBaseNlink(self.dataOb, new, 1)
+        pipeline = getPipeline(self.config)
+        couchOb, replaced = pipeline.map(self._lookup, (old, new))
+        if not couchOb:
+            raise FuseOSError(ENOENT)
+        saves = []
+        if replaced:
+            #Whatever was at new is overwritten, a folder can only be replaced while it's empty
+            saves.append(pipeline.submit(self.database.delete_doc, replaced.to_json()))
+        if isinstance(couchOb, dbFolder):
+            saves.append(pipeline.submit(couchOb.renameTo, new))
+        else:
+            couchOb.path = new
+            saves.append(pipeline.submit(couchOb.save))
+        pipeline.gather(saves)
+        self._recordRemote('rename', old, new, holder=couchOb.node)
+        if self.snapshot:
+            self.snapshot.moveTree(old, new) #The changes feed may already have written moved children under new
+            self.snapshot.put(new, couchOb.getAttributes(), couchOb._id)
+        self.cache.move(old, new) #What's cached below a moved folder stays cached, its inode numbers don't change
 
         """Update the filesystem"""
         fullOldPath = self.base + old
         fullNewPath = self.base + new
         if os.path.exists(fullOldPath):
+            self._ensureParent(new)
             os.rename(fullOldPath, fullNewPath)
+        self.handles.rename(old, new)
 
+    @_lockingPaths()
     def rmdir(self, path):
         """Remove the CouchDB metadata"""
         if self.debug == True:
             logging.debug("in rmdir")
+        #Checked before anything changes, so a folder that isn't empty is left as it was
+        fullPath = self.base + path
+        if os.path.isdir(fullPath) and os.listdir(fullPath):
+            raise FuseOSError(ENOTEMPTY)
+        if childCounts(self.database, [path])[path]:
+            raise FuseOSError(ENOTEMPTY) #Holds files that only other nodes have
         dbView = dbFolder(self.dataOb)
-        folder = dbView.view('dvfs/dbFolder-all', key=path).one()
+        folder = dbView.view('dvfs/dbFolder-all', key=path, include_docs=True).one()
+        if folder is None:
+            raise FuseOSError(ENOENT)
         folder.delete()
-        _addBaseNlink(self.dataOb, path, -1)
+        self._recordRemote('delete', path)
+        if self.snapshot:
+            self.snapshot.removeTree(path)
+        self.cache.evictTree(path)
+        self.cache.evict(os.path.dirname(path))
 
         """Delete the base file system folder, if it exists"""
-        fullPath = self.base + path
         if os.path.isdir(fullPath):
             os.rmdir(fullPath)
 
+    @_lockingPaths()
     def setxattr(self, path, name, value, options, position=0):
         # Ignore options
         if self.debug == True:
@@ -254,10 +607,12 @@ class dvfs(LoggingMixIn, Operations):
         dbView = dbObject(self.dataOb)
         couchOb = dbView.view('dvfs/dbObject-all',
             key=path,
+            include_docs=True,
             classes={'dbFolder':dbFolder, 'dbFile': dbFile}
         ).one()
         couchOb[name] = value
         couchOb.save()
+        self.cache.evict(path)
 
     def statfs(self, path):
         if self.debug == True:
@@ -270,40 +625,52 @@ class dvfs(LoggingMixIn, Operations):
             logging.debug("in symlink")
         raise FuseOSError(ENOENT)
 
+    @_lockingPaths()
     def truncate(self, path, length, fh=None):
         if self.debug == True:
             logging.debug("in truncate")
         fullPath = self.base + path
-        with open(fullPath, 'wb+') as fb:
-            fb.truncate(length)
+        if not os.path.exists(fullPath):
+            self._fetch(path) #Changing a remote file makes this node hold it
+        self.handles.flushWrites(path) #Or they'd extend the file again once written
+        self.handles.invalidate(path)
+        if fh and self.handles.get(fh):
+            self.handles.get(fh).truncate(length)
+        else:
+            with open(fullPath, 'r+b') as fb:
+                fb.truncate(length)
+        if self.handles.forPath(path):
+            #Saved along with the other pending changes when the handles are flushed
+            self.handles.setSize(path, length)
+            return
 
         dbView = dbFile(self.dataOb)
-        info = dbView.view('dvfs/dbFile-all', key=path).one()
-        info.updateInfo(fullPath)
-
+        info = dbView.view('dvfs/dbFile-all', key=path, include_docs=True).one()
+        info.node = self.node
+        info.updateInfo(fullPath, self.config['hashAlgorithm'], hashPool=self.hashPool)
+        self.cache.evict(path)
 
+    @_lockingPaths()
     def unlink(self, path):
         if self.debug == True:
             logging.debug("in unlink")
         fullPath = self.base + path
-        os.remove(fullPath)
+        if os.path.exists(fullPath):
+            os.remove(fullPath) #A remote file only has its document
         dbView = dbFile(self.dataOb)
-        info = dbView.view('dvfs/dbFile-all', key=path).one()
+        info = dbView.view('dvfs/dbFile-all', key=path, include_docs=True).one()
         info.delete()
-        _addBaseNlink(self.dataOb, path, -1)
+        self._recordRemote('delete', path, holder=info.node)
+        if self.snapshot:
+            self.snapshot.remove(path)
+        self.cache.evict(path)
+        self.cache.evict(os.path.dirname(path))
 
+    @_lockingPaths()
     def utimens(self, path, times=None):
         if self.debug == True:
             logging.debug("in utimens")
         dbView = dbObject(self.dataOb)
-        try:
-            info = dbView.view('dvfs/dbObject-all',
-                key=path,
-                classes={'dbFolder':dbFolder, 'dbFile': dbFile}
-            ).one()
-        except:
-            raise FuseOSError(ENOENT)
-
         if times:
             if self.debug == True:
                 logging.debug(times)
@@ -311,28 +678,30 @@ class dvfs(LoggingMixIn, Operations):
         else:
             now = datetime.now()
             inTimes = (now, now)
-        info.accessTime, info.modifyTime = inTimes
-        info.save()
+        def save():
+            info = dbView.view('dvfs/dbObject-all',
+                key=path,
+                include_docs=True,
+                classes={'dbFolder':dbFolder, 'dbFile': dbFile}
+            ).one()
+            if not info:
+                raise FuseOSError(ENOENT)
+            info.accessTime, info.modifyTime = inTimes
+            info.save()
+        retrying(save)
+        self.cache.evict(path)
 
     def write(self, path, data, offset, fh):
         if self.debug == True:
             logging.debug("In write")
-        fullPath = self.base + path
-        with open(fullPath, 'wb') as f:
-            f.seek(offset)
-            f.write(data)
-        dbView = dbFile(self.dataOb)
-        try:
-            if self.debug == True:
-                logging.debug("in try statement")
-                logging.debug(path)
-            info = dbView.view('dvfs/dbFile-all', key=path).one()
-            info.updateInfo(fullPath)
-        except:
-            if self.debug == True:
-                logging.debug("in except")
-            raise FuseOSError(ENOENT)
-        return len(data)
+        handle = self._getHandle(fh)
+        written = handle.write(data, offset)
+        self.handles.invalidate(path)
+        if handle.hasher:
+            handle.hasher.update(data[:written], offset)
+        #The document is saved on flush/fsync/release (or by the flusher), not for every chunk
+        handle.markDirty(offset + written)
+        return written
 
     def _updateFileInfo(self, path, create=False, mode=False, accessTime=False, modifyTime=False):
         """Updates the couchdb's metadata based on the actual file"""
@@ -340,7 +709,7 @@ class dvfs(LoggingMixIn, Operations):
         dbView = dbFile(self.dataOb)
         info = False
         try:
-            info = dbView.view('dvfs/dbFile-all', key=path).one()
+            info = dbView.view('dvfs/dbFile-all', key=path, include_docs=True).one()
         except:
             if self.debug == True:
                 logging.debug("file data not found")
@@ -357,17 +726,57 @@ class dvfs(LoggingMixIn, Operations):
                 info.accessTime = accessTime
             if modifyTime:
                 info.modifyTime = modifyTime
-            info.st_size = os.path.getsize(fullPath)
-            info.hash = md5(fullPath).hexdigest()
+            info.updateHash(fullPath, self.config['hashAlgorithm'])
             info.save()
+            self.cache.evict(path)
 
-    def _loadFolder(self, path):
-        """Loads all files inside a folder, inserting them into the database if they aren't already there or removing them if they shouldn't be"""
-        fullPath = self.base + path
-        files = []
-        for root, dirs, files in os.walk(fullPath):
-            for fileName in files:
-                files.append(root + '/' + fileName)
+    def _recordRemote(self, action, path, newPath=None, holder=None):
+        """Records a delete or rename for the other nodes to apply to their base folders"""
+        try:
+            nodes = knownNodes(self.database)
+            nodes.add(holder)
+            recordRemoteChange(self.database, nodes, self.node, action, path, newPath)
+        except Exception:
+            logging.exception("unable to record the %s of %s for the other nodes" % (action, path))
+
+    def _remoteChangeApplied(self, action, path, newPath):
+        if action == 'rename':
+            self.handles.rename(path, newPath)
+
+    def _applyRemoteChanges(self):
+        try:
+            self.remoteChanges.applyPending()
+        except Exception:
+            logging.exception("unable to apply the deletes and renames made on other nodes")
+
+    def _loadFolder(self):
+        """Loads all files inside the base folder, inserting them into the database if they aren't already there or removing them if they shouldn't be"""
+        if self.debug == True:
+            logging.debug("reconciling the base folder")
+        self._applyRemoteChanges() #So files deleted or renamed elsewhere aren't imported again
+        writer = bulkWriter(self.database, self.config['bulkWindow'], self.config['bulkSize'])
+        try:
+            reconciler(self.base, self.database, writer,
+                hashPool=self.hashPool,
+                algorithm=self.config['hashAlgorithm'],
+                workers=self.config['reconcileWorkers'],
+                pageSize=self.config['listPageSize'],
+                node=self.node
+            ).run()
+        except Exception:
+            logging.exception("unable to reconcile the base folder")
+        finally:
+            writer.stop()
+
+def mountOptions(options):
+    """Turns fuse options written as 'name,name=value,...' into keyword arguments for FUSE"""
+    parsed = dict()
+    for option in options.split(','):
+        option = option.strip()
+        if option:
+            name, _, value = option.partition('=')
+            parsed[name] = value if value else True
+    return parsed
 
 def createProcesses(baseFolder, databaseName):
     """Creates the processes needed for the other components"""
@@ -389,11 +798,20 @@ if __name__ == '__main__':
     parser.add_argument("target", help="The folder to access the filesystem through")
     parser.add_argument("-f", "--foreground", action="store_true", help="Keep the application in the foreground")
     parser.add_argument("-d", "--debug", action="store_true", help="Activates debug mode")
+    parser.add_argument("-s", "--single-threaded", action="store_true", help="Handle one filesystem call at a time")
+    parser.add_argument("-o", "--options", default='', help="Comma separated fuse mount options (big_writes, max_read=N, kernel_cache, auto_cache, attr_timeout=N, entry_timeout=N, use_ino...), added to the mountOptions setting")
     args = parser.parse_args()
 
-    processes = createProcesses(args.base, 'dvfs')
+    config = loadConfig()
+    processes = createProcesses(args.base, config['dbName'])
 
     if args.debug == True:
         logging.basicConfig(filename='debug.log', level=logging.DEBUG)
         logging.getLogger().setLevel(logging.DEBUG)
-    fuse = FUSE(dvfs(args.base, args.debug), args.target, foreground=args.foreground)
+    options = mountOptions(config['mountOptions'])
+    options.update(mountOptions(args.options))
+    fuse = FUSE(dvfs(args.base, args.debug, config), args.target,
+        foreground=args.foreground,
+        nothreads=args.single_threaded,
+        **options
+    )
@@ -0,0 +1,94 @@
+"""
+    dvfsConfig: Loads the shared config.ini settings, filling in defaults for anything that isn't set
+"""
+
+import os
+import socket
+from configobj import ConfigObj
+
+defaults = {
+    'dbName': 'dvfs',
+    'couchUrl': 'http://127.0.0.1:5984',
+    'dbPoolSize': 20, #Keep-alive connections kept open to CouchDB, per process
+    'dbTimeout': 30.0, #Seconds before a CouchDB request is given up on
+    'dbRetries': 3, #Times a conflicting save or a failed request (5xx or lost connection) is tried again
+    'dbBackoff': 0.2, #Seconds waited before the first retry, doubling after each one
+    'dbPipelineWorkers': 8, #Independent CouchDB requests made at the same time, should stay below dbPoolSize
+    'cacheSize': 100000, #Maximum number of paths held in the metadata cache
+    'cacheTTL': 30.0, #Seconds before a cached entry is fetched again, even without a change notification
+    'missingCacheSize': 10000, #Maximum number of paths remembered as not existing
+    'missingCacheTTL': 2.0, #Seconds a path is remembered as not existing
+    'listPageSize': 1000, #Rows fetched per request when listing large folders
+    'useSnapshot': True, #Keep a local copy of the metadata so mounting doesn't wait on CouchDB
+    'snapshotPath': '', #Where that copy is kept, next to config.ini when empty
+    'hashAlgorithm': 'sha256', #Any hashlib algorithm this python supports, used for dbFile.fileHash
+    'hashWorkers': 2, #Background threads hashing changed files, 0 hashes them inline
+    'storeChunks': False, #Split files into content defined chunks while hashing, kept by hash for transfers. Costs a copy of every hashed file and CPU held under the GIL
+    'chunkPath': '', #Where chunks are kept, next to config.ini when empty
+    'chunkMin': 65536, #Smallest chunk in bytes, except for the end of a file
+    'chunkAvg': 262144, #Average chunk size in bytes, a power of two. Peers must use the same chunk sizes
+    'chunkMax': 1048576, #Largest chunk in bytes
+    'chunkGcInterval': 3600.0, #Seconds between removing chunks no current file lists, 0 never removes them
+    'transfer': True, #Serve this node's file contents to peers and fetch missing contents from them
+    'nodeName': '', #Unique name this node advertises itself under, the host name and base folder when empty
+    'transferSecret': '', #Shared by every node, requests for contents not signed with it are refused. Transfers are off while it's empty
+    'transferHost': '127.0.0.1', #Address the transfer server listens on, peers on other hosts need a reachable one
+    'transferPort': 0, #Port the transfer server listens on, any free one when 0
+    'transferWorkers': 4, #Chunks fetched at the same time, spread over the peers that have them
+    'transferTimeout': 30.0, #Seconds before a peer that stopped answering is given up on
+    'peerTTL': 60.0, #Seconds a peer stays listed after it last announced itself
+    'partialPath': '', #Where fetched files are assembled, next to config.ini when empty
+    'hydratePath': '', #Where remote only files opened for reading are fetched to, next to config.ini when empty
+    'hydrateMaxBytes': 10737418240, #Bytes of unused fetched files kept before the least recently used are evicted
+    'quietPeriod': 1.0, #Seconds a base folder path must go without events before its net change is saved
+    'maxHold': 10.0, #Seconds a base folder path that never goes quiet is held before its net change is saved anyway
+    'bulkWindow': 0.5, #Seconds the base folder watcher collects changes before saving them together
+    'bulkSize': 500, #Most documents saved by the watcher in one request
+    'reconcileOnMount': True, #Compare the base folder with the database when mounting
+    'reconcileWorkers': 4, #Top level folders compared at the same time
+    'readAheadMin': 131072, #Bytes read ahead once a handle is read sequentially, doubling while it keeps up
+    'readAheadMax': 8388608, #Most bytes read ahead of each handle, 0 turns reading ahead off
+    'readAheadWorkers': 2, #Threads reading ahead for all the open handles
+    'writeBufferSize': 1048576, #Bytes of small adjacent writes collected per handle before writing them at once, 0 writes each
+    'mountOptions': 'big_writes,max_read=131072,auto_cache,attr_timeout=1,entry_timeout=1,use_ino', #fuse -o options, see --options
+    'metaFlushInterval': 5.0, #Seconds a written file's metadata can stay unsaved while it's open, 0 waits for the close
+}
+
+def _convert(default, value):
+    """Converts a config string into the type of its default value"""
+    if isinstance(default, bool):
+        return str(value).lower() in ('1', 'true', 'yes', 'on')
+    if isinstance(default, str) and isinstance(value, list):
+        return ','.join(value) #ConfigObj splits comma separated values into lists
+    return type(default)(value)
+
+def configFolder():
+    """The folder holding config.ini, where local state like the metadata snapshot is kept as well"""
+    return os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+def nodeName(config, base):
+    """The name this node goes by, for its peer document and the documents of the files it holds"""
+    return config['nodeName'] or '%s:%s' % (socket.gethostname(), os.path.realpath(base))
+
+def loadConfig(path=False):
+    """Returns a dictionary of the settings inside config.ini, using the defaults for missing values
+        The DVFS_CONFIG environment variable can point at another file, for several nodes on one machine.
+    """
+    if not path:
+        path = os.environ.get('DVFS_CONFIG') or os.path.join(configFolder(), 'config.ini')
+    config = dict(defaults)
+    if os.path.exists(path):
+        for key, value in ConfigObj(path).items():
+            if key in defaults:
+                config[key] = _convert(defaults[key], value)
+            else:
+                config[key] = value
+    if not config['snapshotPath']:
+        config['snapshotPath'] = os.path.join(configFolder(), config['dbName'] + '-snapshot.sqlite')
+    if not config['partialPath']:
+        config['partialPath'] = os.path.join(configFolder(), config['dbName'] + '-partial')
+    if not config['hydratePath']:
+        config['hydratePath'] = os.path.join(configFolder(), config['dbName'] + '-hydrated')
+    if not config['chunkPath']:
+        config['chunkPath'] = os.path.join(configFolder(), config['dbName'] + '-chunks')
+    return config
@@ -0,0 +1,186 @@
+"""
+    eventCoalescer: Folds bursts of filesystem events into the net change for each path before it's saved
+    For example create + modify*N becomes create, create + delete becomes nothing and a chain of moves becomes one move
+    Moves are followed by the document they carry (the path it had when the events started), so chains that pass
+    back through a path, like swapping two files through a temporary name, still come out as the right moves.
+"""
+
+import logging
+import os
+import threading
+import time
+
+
+class pendingEvent(object):
+    """The net change to one path since its events started arriving"""
+    def __init__(self, path, directory, basePath, origin):
+        self.path = path
+        self.directory = directory
+        self.basePath = basePath
+        self.origin = origin #The path whose document is now here, None for a new object that needs creating
+        self.modified = False
+        self.first = self.last = time.time()
+
+
+class eventCoalescer(object):
+    """Holds events until their path has been quiet for quietPeriod seconds (or held for maxHold), then passes on
+        the net change
+        Moves and deletes of existing documents depend on each other, so they're passed on together once all of
+        them are quiet. target must provide applyCreated(path, directory, basePath), applyDeleted(path),
+        applyModified(path, basePath) and applyMoves([(source, path)]), with the moves applied all at once.
+    """
+    def __init__(self, target, quietPeriod=1.0, maxHold=10.0):
+        self.target = target
+        self.quietPeriod = quietPeriod
+        self.maxHold = maxHold #A path that never goes quiet, like an appended log, is still saved this often
+        self.lock = threading.Lock()
+        self.pending = dict() #path -> pendingEvent
+        self.vacated = dict() #original path -> is a folder, for documents moved away from or deleted at their path
+        self.structuralFirst = self.structuralLast = None #When the moves and deletes started and last changed
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='dvfs-coalescer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _take(self, path, directory, basePath):
+        """Removes and returns the entry for what's at path, one for its original document if it has no entry
+            Returns None if nothing that has a document is known to be there
+        """
+        entry = self.pending.pop(path, None)
+        if entry is None and path not in self.vacated:
+            entry = pendingEvent(path, directory, basePath, path)
+        return entry
+
+    def _entry(self, path, directory, basePath):
+        entry = self.pending.get(path)
+        if entry is None:
+            entry = self.pending[path] = pendingEvent(path, directory, basePath, None if path in self.vacated else path)
+        entry.last = time.time()
+        entry.basePath = basePath
+        return entry
+
+    def _vacate(self, entry):
+        """Notes that entry's original document left its path"""
+        if entry is not None and entry.origin is not None and entry.origin not in self.vacated:
+            self.vacated[entry.origin] = entry.directory
+        self._structural()
+
+    def _structural(self):
+        now = time.time()
+        if self.structuralFirst is None:
+            self.structuralFirst = now
+        self.structuralLast = now
+
+    def created(self, path, directory, basePath):
+        with self.lock:
+            entry = self.pending.pop(path, None)
+            if entry is not None and entry.origin is not None:
+                self._vacate(entry) #Replaced without a delete event
+            self.pending[path] = pendingEvent(path, directory, basePath, None)
+            if path in self.vacated:
+                self._structural()
+
+    def modified(self, path, directory, basePath):
+        with self.lock:
+            entry = self._entry(path, directory, basePath)
+            if entry.origin is not None:
+                entry.modified = True
+
+    def deleted(self, path, directory, basePath):
+        with self.lock:
+            entry = self._take(path, directory, basePath)
+            if entry is not None and entry.origin is not None:
+                self._vacate(entry) #A new object that was never saved just disappears
+
+    def moved(self, source, path, directory, basePath):
+        with self.lock:
+            moving = self._take(source, directory, basePath)
+            self._vacate(self._take(path, directory, basePath)) #Whatever was at path is overwritten
+            if moving is None:
+                moving = pendingEvent(path, directory, basePath, None) #Not known to have a document, so created
+            else:
+                self._vacate(moving)
+            moving.path = path
+            moving.basePath = basePath
+            moving.last = time.time()
+            self.pending[path] = moving
+
+    def _run(self):
+        while not self.stopped.wait(self.quietPeriod / 2.0):
+            self.flush(time.time() - self.quietPeriod, time.time() - self.maxHold)
+
+    def _isStructural(self, entry):
+        return entry.origin not in (None, entry.path) or entry.path in self.vacated
+
+    def flush(self, before=None, heldSince=None):
+        """Passes on every change whose path has been quiet since before or held since heldSince (or all of them)"""
+        def isReady(first, last):
+            return before is None or last <= before or (heldSince is not None and first <= heldSince)
+
+        with self.lock:
+            held = [entry for entry in self.pending.values() if self._isStructural(entry)]
+            plain = [entry for entry in self.pending.values() if not self._isStructural(entry)]
+            moves = deletes = structural = []
+            if held or self.vacated:
+                first = min([entry.first for entry in held] + [self.structuralFirst or time.time()])
+                last = max([entry.last for entry in held] + [self.structuralLast or 0])
+                if isReady(first, last):
+                    moves, deletes, structural = self._resolve(held)
+                    held = []
+            ready = [entry for entry in plain if isReady(entry.first, entry.last)]
+            #A new folder's contents wait for the folder, and anything under a held move waits for the move
+            waiting = set(entry.path for entry in plain if entry.origin is None and entry not in ready)
+            waiting.update(entry.path for entry in held)
+            ready = [entry for entry in ready if not _insideAny(entry.path, waiting)] + structural
+            for entry in ready:
+                del self.pending[entry.path]
+
+        try:
+            for path in deletes:
+                self.target.applyDeleted(path)
+            if moves:
+                self.target.applyMoves(moves)
+        except Exception:
+            logging.exception("unable to apply the moves and deletes %s %s" % (moves, deletes))
+        for entry in sorted(ready, key=lambda entry: entry.path.count('/')):
+            try:
+                self._apply(entry)
+            except Exception:
+                logging.exception("unable to apply the changes to %s" % entry.path)
+
+    def _resolve(self, structural):
+        """Turns the moves and deletes collected so far into (moves, deletes, entries), the caller holds the lock
+            A new object landing on a path whose document left it without going anywhere, like an editor saving
+            over a file through a temporary one, isn't deleted first, so its create keeps that document.
+        """
+        carried = set(entry.origin for entry in self.pending.values() if entry.origin is not None)
+        for entry in structural:
+            if entry.origin is None and entry.path not in carried and self.vacated.get(entry.path) == entry.directory:
+                carried.add(entry.path)
+        deletes = sorted((path for path in self.vacated if path not in carried), key=lambda path: -path.count('/'))
+        moves = [(entry.origin, entry.path) for entry in structural if entry.origin not in (None, entry.path)]
+        self.vacated = dict()
+        self.structuralFirst = self.structuralLast = None
+        return moves, deletes, structural
+
+    def _apply(self, entry):
+        if entry.origin is None:
+            self.target.applyCreated(entry.path, entry.directory, entry.basePath)
+        elif entry.modified:
+            self.target.applyModified(entry.path, entry.basePath)
+
+    def stop(self):
+        """Passes on everything still held and stops the background thread"""
+        self.stopped.set()
+        self.flush()
+
+
+def _insideAny(path, folders):
+    """Returns True if path is inside any of the folders"""
+    parent = os.path.dirname(path)
+    while True:
+        if parent in folders:
+            return True
+        if parent in ('/', ''):
+            return False
+        parent = os.path.dirname(parent)
@@ -0,0 +1,274 @@
+"""
+    fileHandles: Maps the handles given to FUSE onto open base file descriptors
+"""
+
+import logging
+import os
+import threading
+import time
+
+from fileHasher import incrementalHash
+from readAhead import readAhead
+
+
+class fileHandle(object):
+    """An open base file, read and written at explicit offsets"""
+    def __init__(self, path, fd, flags, writeBufferSize=0):
+        self.path = path #The dvfs path, kept up to date across renames
+        self.fd = fd
+        self.flags = flags
+        self.lock = threading.Lock() #Only needed when os.pread/os.pwrite aren't available
+        self.size = os.fstat(fd).st_size
+        self.dirty = False #True when the base file changed but its dbFile document hasn't been updated
+        self.dirtySince = None
+        self.stateLock = threading.Lock()
+        self.hasher = None #Set when the file starts empty, so its hash can be built as it's written
+        self.waitFor = None #Called with (offset, size) before reading, for files still being fetched
+        self.onClose = None
+        self.readAhead = None #Set for handles only read from
+        self.writeBufferSize = writeBufferSize #Bytes of adjacent writes collected before they're written, 0 doesn't
+        self.bufferLock = threading.Lock()
+        self.buffered = [] #Adjacent writes not written to the base file yet, starting at bufferedOffset
+        self.bufferedOffset = 0
+        self.bufferedSize = 0
+
+    def markDirty(self, size=None, extend=True):
+        """Records a change that still needs saving to the database, along with the file's new size"""
+        with self.stateLock:
+            if size is not None:
+                self.size = max(self.size, size) if extend else size
+            if not self.dirty:
+                self.dirty = True
+                self.dirtySince = time.time()
+
+    def takeDirty(self):
+        """Clears the dirty flag, returning whether it was set"""
+        with self.stateLock:
+            wasDirty = self.dirty
+            self.dirty = False
+            self.dirtySince = None
+            return wasDirty
+
+    def read(self, size, offset):
+        """Reads up to size bytes starting at offset"""
+        if self.readAhead is not None:
+            return self.readAhead.read(size, offset)
+        return self._read(size, offset)
+
+    def _read(self, size, offset):
+        if self.waitFor is not None:
+            self.waitFor(offset, size)
+        if hasattr(os, 'pread'):
+            return os.pread(self.fd, size, offset)
+        with self.lock:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            return os.read(self.fd, size)
+
+    def write(self, data, offset):
+        """Writes all of data at offset, returning the number of bytes written
+            Small writes continuing the previous one are collected and written together once writeBufferSize
+            bytes are waiting, or by flushWrites. An error writing them is raised from the call that writes them.
+        """
+        if len(data) >= self.writeBufferSize:
+            self.flushWrites()
+            return self._write(data, offset)
+        with self.bufferLock:
+            if self.buffered and offset != self.bufferedOffset + self.bufferedSize:
+                self._writeBuffered()
+            if not self.buffered:
+                self.bufferedOffset = offset
+            self.buffered.append(data)
+            self.bufferedSize += len(data)
+            if self.bufferedSize >= self.writeBufferSize:
+                self._writeBuffered()
+        return len(data)
+
+    def flushWrites(self):
+        """Writes any collected writes to the base file"""
+        if self.buffered:
+            with self.bufferLock:
+                self._writeBuffered()
+
+    def _writeBuffered(self):
+        if not self.buffered:
+            return
+        data = ''.join(self.buffered)
+        offset = self.bufferedOffset
+        self.buffered = []
+        self.bufferedSize = 0
+        self._write(data, offset)
+
+    def _write(self, data, offset):
+        if hasattr(os, 'pwrite'):
+            written = 0
+            while written < len(data):
+                written += os.pwrite(self.fd, data[written:], offset + written)
+            return written
+        with self.lock:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            written = 0
+            while written < len(data):
+                written += os.write(self.fd, data[written:])
+            return written
+
+    def truncate(self, length):
+        self.flushWrites()
+        os.ftruncate(self.fd, length)
+
+    def fsync(self, datasync=False):
+        self.flushWrites()
+        if datasync and hasattr(os, 'fdatasync'):
+            os.fdatasync(self.fd)
+        else:
+            os.fsync(self.fd)
+
+    def close(self):
+        try:
+            self.flushWrites()
+        finally:
+            os.close(self.fd)
+        if self.onClose is not None:
+            self.onClose()
+
+
+class handleTable(object):
+    """The open file handles of a mount, safe to use from several FUSE threads"""
+    def __init__(self, prefetcher=None, writeBufferSize=0):
+        self.handles = dict() #fh -> fileHandle
+        self.lock = threading.Lock()
+        self.lastFh = 0
+        self.prefetcher = prefetcher #The readAhead prefetchPool, None to only read what's asked for
+        self.readingAhead = 0 #Open handles with a readAhead, so writes only look for them when there are any
+        self.writeBufferSize = writeBufferSize #Given to handles opened for writing
+        self.buffering = 0 #Open handles that may hold collected writes, so reads only look for them when there are any
+
+    def open(self, path, fullPath, flags, mode=0644, hashAlgorithm=None):
+        """Opens the base file and returns the new handle's number, raises OSError if it can't be opened
+            With a hashAlgorithm, files opened empty for writing are hashed incrementally as they're written
+        """
+        writing = flags & (os.O_WRONLY | os.O_RDWR)
+        fd = os.open(fullPath, flags, mode)
+        try:
+            handle = fileHandle(path, fd, flags, self.writeBufferSize if writing else 0)
+        except (OSError, EnvironmentError):
+            os.close(fd)
+            raise
+        if not writing:
+            self._readAhead(handle)
+        with self.lock:
+            others = [other for other in self.handles.values() if other.path == path]
+            if writing:
+                #Writes through several handles can't be followed by any one of them
+                for other in others:
+                    other.hasher = None
+                if hashAlgorithm and handle.size == 0 and not any(other.flags & (os.O_WRONLY | os.O_RDWR) for other in others):
+                    handle.hasher = incrementalHash(hashAlgorithm)
+                if handle.writeBufferSize:
+                    self.buffering += 1
+            self.lastFh += 1
+            self.handles[self.lastFh] = handle
+            return self.lastFh
+
+    def add(self, path, fd, flags, waitFor=None, onClose=None):
+        """Adds a handle for an fd opened elsewhere, like a hydrated copy of a remote file, returning its number"""
+        handle = fileHandle(path, fd, flags)
+        handle.waitFor = waitFor
+        handle.onClose = onClose
+        if not flags & (os.O_WRONLY | os.O_RDWR):
+            self._readAhead(handle)
+        with self.lock:
+            self.lastFh += 1
+            self.handles[self.lastFh] = handle
+            return self.lastFh
+
+    def _readAhead(self, handle):
+        if self.prefetcher is not None:
+            handle.readAhead = readAhead(self.prefetcher, handle._read)
+            with self.lock:
+                self.readingAhead += 1
+
+    def get(self, fh):
+        """Returns the handle for fh, or None if it isn't open"""
+        return self.handles.get(fh)
+
+    def release(self, fh):
+        """Removes fh from the table and closes it, returning the closed handle"""
+        with self.lock:
+            handle = self.handles.pop(fh, None)
+            if handle is not None and handle.readAhead is not None:
+                self.readingAhead -= 1
+            if handle is not None and handle.writeBufferSize:
+                self.buffering -= 1
+        if handle is not None:
+            handle.close()
+        return handle
+
+    def dirtySize(self, path):
+        """Returns the in memory size of path if an open handle has unsaved changes to it, otherwise None"""
+        sizes = [handle.size for handle in self.forPath(path) if handle.dirty]
+        return max(sizes) if sizes else None
+
+    def setSize(self, path, size):
+        """Marks every handle of path dirty at exactly size, after a truncate"""
+        for handle in self.forPath(path):
+            handle.markDirty(size, extend=False)
+            if handle.hasher:
+                handle.hasher.invalidate()
+
+    def flushWrites(self, path):
+        """Writes the writes collected by path's handles, so the base file can be read or changed directly"""
+        if not self.buffering:
+            return
+        for handle in self.forPath(path):
+            handle.flushWrites()
+
+    def invalidate(self, path):
+        """Drops what was read ahead of path's handles, after it was written or truncated"""
+        if not self.readingAhead:
+            return
+        for handle in self.forPath(path):
+            if handle.readAhead is not None:
+                handle.readAhead.invalidate()
+
+    def dirtyFor(self, seconds):
+        """Returns the handles which have had unsaved changes for at least seconds"""
+        cutoff = time.time() - seconds
+        with self.lock:
+            handles = list(self.handles.values())
+        return [handle for handle in handles if handle.dirty and handle.dirtySince <= cutoff]
+
+    def forPath(self, path):
+        """Returns every open handle of path"""
+        with self.lock:
+            return [handle for handle in self.handles.values() if handle.path == path]
+
+    def rename(self, old, new):
+        """Updates the paths of open handles after old (a file or folder) was renamed to new"""
+        with self.lock:
+            for handle in self.handles.values():
+                if handle.path == old:
+                    handle.path = new
+                elif handle.path.startswith(old + '/'):
+                    handle.path = new + handle.path[len(old):]
+
+
+class dirtyFlusher(threading.Thread):
+    """Periodically passes handles that have been dirty for too long to a flush callback"""
+    def __init__(self, handles, flush, interval):
+        super(dirtyFlusher, self).__init__(name='dvfs-flusher')
+        self.daemon = True
+        self.handles = handles
+        self.flush = flush
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            for handle in self.handles.dirtyFor(self.interval):
+                try:
+                    self.flush(handle)
+                except Exception:
+                    logging.exception("unable to save the metadata of %s" % handle.path)
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,77 @@
+"""
+    fileHasher: Hashes the contents of base files for dbFile.fileHash
+"""
+
+import hashlib
+
+defaultAlgorithm = 'sha256'
+chunkSize = 1 << 20 #Bytes read at a time, so hashing never holds more than this in memory
+
+
+def newHash(algorithm=defaultAlgorithm):
+    """Returns a new hashlib object, raises ValueError if this python doesn't support the algorithm"""
+    return hashlib.new(algorithm)
+
+def hashFile(path, algorithm=defaultAlgorithm):
+    """Returns the hex digest of the file's contents, or the emptystring if the file is empty"""
+    digest = fileDigest(algorithm)
+    with open(path, 'rb') as hashedFile:
+        while True:
+            chunk = hashedFile.read(chunkSize)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.finish()[0]
+
+
+class fileDigest(object):
+    """Builds a file's hash and, given a chunkStore, stores its content defined chunks in the same pass"""
+    def __init__(self, algorithm=defaultAlgorithm, store=None):
+        self.digest = newHash(algorithm)
+        self.length = 0
+        self.store = store
+        self.splitter = store.chunker() if store else None
+        self.chunks = [] if store else None
+
+    def update(self, data):
+        self.digest.update(data)
+        self.length += len(data)
+        if self.splitter:
+            for chunk in self.splitter.update(data):
+                self.chunks.append(self.store.put(chunk))
+
+    def finish(self):
+        """Returns (fileHash, chunks), chunks being the [hash, size] list for dbFile.chunks or None without a store"""
+        if self.splitter:
+            chunk = self.splitter.finish()
+            if chunk:
+                self.chunks.append(self.store.put(chunk))
+        return (self.digest.hexdigest() if self.length else ''), self.chunks
+
+
+class incrementalHash(object):
+    """Hashes a file as it's written, which only works while every write continues where the last one ended
+        Anything else (rewrites, holes, truncates) gives up and the file is hashed from disk instead
+    """
+    def __init__(self, algorithm=defaultAlgorithm):
+        self.digest = newHash(algorithm)
+        self.position = 0
+        self.valid = True
+
+    def update(self, data, offset):
+        if not self.valid:
+            return
+        if offset != self.position:
+            self.valid = False
+            return
+        self.digest.update(data)
+        self.position += len(data)
+
+    def invalidate(self):
+        self.valid = False
+
+    def hexdigest(self, size):
+        """Returns the digest if the whole file of length size went through this hash, otherwise None"""
+        if not self.valid or self.position != size:
+            return None
+        return self.digest.hexdigest() if size else ''
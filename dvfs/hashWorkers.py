@@ -0,0 +1,155 @@
+"""
+    hashWorkers: Hashes changed files on background threads and writes the result back to their dbFile documents
+    hashlib releases the GIL while it hashes, so the workers don't hold up the FUSE threads
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from dbConnection import retrying
+from dbObjects import dbFile, saveChunkList
+from fileHasher import fileDigest, chunkSize, defaultAlgorithm
+
+
+class hashPool(object):
+    """A fixed number of worker threads hashing queued files
+        Jobs are keyed by path: submitting a path that's already queued just updates the job, and a path that
+        changes while it's being hashed cancels the running job in favour of a new one.
+        With a chunkStore, the file's chunks are stored and listed in the same pass.
+    """
+    def __init__(self, database, workers=2, algorithm=defaultAlgorithm, store=None):
+        self.database = database
+        self.algorithm = algorithm
+        self.store = store
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.queue = deque() #Paths waiting for a worker, in submission order
+        self.jobs = dict() #path -> [generation, base path], for queued and running jobs
+        self.running = True
+        self.active = 0
+        self.hashedBytes = 0
+        self.hashingTime = 0.0
+        self.completed = 0
+        self.cancelled = 0
+        self.threads = []
+        for number in range(workers):
+            thread = threading.Thread(target=self._work, name='dvfs-hash-%d' % number)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, path, basePath):
+        """Queues path to be hashed from basePath, replacing any job for it that hasn't finished"""
+        with self.lock:
+            job = self.jobs.get(path)
+            if job is None:
+                self.jobs[path] = [1, basePath]
+                self.queue.append(path)
+                self.ready.notify()
+            else:
+                #A running job sees the generation change and stops, then the path is queued again
+                job[0] += 1
+                job[1] = basePath
+                if path not in self.queue:
+                    self.queue.append(path)
+                    self.ready.notify()
+
+    def _current(self, path, generation):
+        with self.lock:
+            job = self.jobs.get(path)
+            return job is not None and job[0] == generation
+
+    def _work(self):
+        while True:
+            with self.lock:
+                while self.running and not self.queue:
+                    self.ready.wait()
+                if not self.running:
+                    return
+                path = self.queue.popleft()
+                generation, basePath = self.jobs[path]
+                self.active += 1
+            try:
+                self._hash(path, generation, basePath)
+            except Exception:
+                logging.exception("unable to hash %s" % path)
+            finally:
+                with self.lock:
+                    self.active -= 1
+                    job = self.jobs.get(path)
+                    if job is not None and job[0] == generation and path not in self.queue:
+                        del self.jobs[path]
+
+    def _hash(self, path, generation, basePath):
+        """Hashes one file, saving the result unless the file changed in the meantime"""
+        try:
+            before = os.stat(basePath)
+        except OSError:
+            return
+        start = time.time()
+        digest = fileDigest(self.algorithm, self.store)
+        with open(basePath, 'rb') as hashedFile:
+            while True:
+                if not self._current(path, generation):
+                    with self.lock:
+                        self.cancelled += 1
+                    return
+                chunk = hashedFile.read(chunkSize)
+                if not chunk:
+                    break
+                digest.update(chunk)
+        with self.lock:
+            self.hashedBytes += digest.length
+            self.hashingTime += time.time() - start
+
+        after = os.stat(basePath)
+        if (after.st_size, after.st_mtime) != (before.st_size, before.st_mtime) or not self._current(path, generation):
+            with self.lock:
+                self.cancelled += 1
+            return
+        fileHash, chunks = digest.finish()
+        self._save(path, fileHash, after, chunks)
+
+    def _save(self, path, fileHash, info, chunks=None):
+        """Writes the hash into path's document, fetching it again if it was updated in the meantime"""
+        if chunks is not None:
+            retrying(lambda: saveChunkList(self.database, fileHash, self.algorithm, chunks))
+        def save():
+            rows = list(self.database.view('dvfs/dbFile-all', key=path, include_docs=True))
+            if not rows:
+                return False
+            record = dbFile.wrap(rows[0]['doc'])
+            record.set_db(self.database)
+            record.recordStat(info)
+            record.fileHash = fileHash
+            record.hashType = self.algorithm
+            record.hashSize = info.st_size
+            record.hashMtime = info.st_mtime
+            if chunks is not None:
+                record.chunkHash = fileHash
+            record.save()
+            return True
+        if retrying(save):
+            with self.lock:
+                self.completed += 1
+
+    def stats(self):
+        """Returns the queue depth and hashing throughput"""
+        with self.lock:
+            return {
+                'queued': len(self.queue),
+                'active': self.active,
+                'completed': self.completed,
+                'cancelled': self.cancelled,
+                'hashedBytes': self.hashedBytes,
+                'MBps': (self.hashedBytes / 1048576.0) / self.hashingTime if self.hashingTime else 0.0,
+                'chunks': self.store.stats() if self.store else {},
+            }
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+            self.ready.notify_all()
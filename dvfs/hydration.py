@@ -0,0 +1,156 @@
+"""
+    hydration: Local copies of remote only files, fetched when they're first opened
+    A file whose document is in the database but whose contents aren't in the base folder stays a placeholder
+    (getattr and readdir answer from its document) until it's opened. Its contents are then fetched into the hydration
+    folder in the background and reads are answered as soon as the bytes they cover arrive. Copies nobody has open
+    are evicted least recently used first once they take up more than maxBytes, back to being placeholders.
+"""
+
+import errno
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+
+class hydratedFile(object):
+    """The local copy of one version of a remote file, complete once job is None"""
+    def __init__(self, key, path, size, job=None):
+        self.key = key
+        self.path = path
+        self.size = size
+        self.job = job
+        self.users = 0 #Open handles reading it, it's never evicted while there are any
+
+    def waitFor(self, offset, length):
+        """Blocks until the bytes from offset to offset + length have been fetched"""
+        job = self.job
+        if job is not None:
+            job.waitFor(offset, length)
+
+
+class hydrationCache(object):
+    """The hydrated copies kept in folder, at most maxBytes of them once those in use are left out"""
+    def __init__(self, folder, engine, maxBytes):
+        self.folder = folder
+        self.engine = engine
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        self.files = OrderedDict() #key -> hydratedFile, least recently used first
+        self.totalBytes = 0
+        self.hits = 0
+        self.fetches = 0
+        self.evictions = 0
+        self._load()
+
+    def _load(self):
+        """Picks up the copies finished by a previous mount, dropping any it left partly fetched"""
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        names = sorted(os.listdir(self.folder), key=lambda name: os.path.getmtime(os.path.join(self.folder, name)))
+        for name in names:
+            fullPath = os.path.join(self.folder, name)
+            if name.endswith('.partial'):
+                os.remove(fullPath)
+                continue
+            size = os.path.getsize(fullPath)
+            self.files[name] = hydratedFile(name, fullPath, size)
+            self.totalBytes += size
+        with self.lock:
+            self._evict()
+
+    def _key(self, record):
+        #A changed file gets a new key, so an outdated copy is never read and ages out on its own
+        return '%s-%s' % (record._id, record.fileHash or 'unhashed')
+
+    def open(self, record):
+        """Returns (hydratedFile, read only fd) for the dbFile record, starting its fetch if it isn't here yet
+            Raises IOError or OSError if the fetch can't be started. Pass the hydratedFile to release once closed.
+        """
+        key = self._key(record)
+        with self.lock:
+            hydrated = self.files.pop(key, None)
+            if hydrated is None:
+                hydrated = self._start(key, record)
+                self.fetches += 1
+            else:
+                self.hits += 1
+            self.files[key] = hydrated #Most recently used
+            fd = os.open(hydrated.job.partial if hydrated.job else hydrated.path, os.O_RDONLY)
+            hydrated.users += 1
+            return hydrated, fd
+
+    def _start(self, key, record):
+        path = os.path.join(self.folder, key)
+        hydrated = hydratedFile(key, path, record.st_size or 0)
+        self.totalBytes += hydrated.size
+        try:
+            hydrated.job = self.engine.start(record, path + '.partial', keepChunks=False, onFinished=self._finished)
+        except:
+            self.totalBytes -= hydrated.size
+            raise
+        self._evict()
+        return hydrated
+
+    def _finished(self, job):
+        """Called once a fetch ends, moving the complete copy to its final name or forgetting a failed one"""
+        with self.lock:
+            hydrated = next((hydrated for hydrated in self.files.values() if hydrated.job is job), None)
+            if hydrated is None:
+                return
+            if job.error is None:
+                os.rename(job.partial, hydrated.path) #Open fds keep reading the same file
+                hydrated.job = None
+                self._evict()
+            else:
+                del self.files[hydrated.key]
+                self.totalBytes -= hydrated.size
+                hydrated.job = None
+                if os.path.exists(job.partial):
+                    os.remove(job.partial)
+
+    def release(self, hydrated):
+        with self.lock:
+            hydrated.users -= 1
+            self._evict()
+
+    def _evict(self):
+        """Removes complete copies nobody has open, least recently used first, until they fit in maxBytes"""
+        for key, hydrated in list(self.files.items()):
+            if self.totalBytes <= self.maxBytes:
+                return
+            if hydrated.users or hydrated.job is not None:
+                continue
+            del self.files[key]
+            self.totalBytes -= hydrated.size
+            self.evictions += 1
+            try:
+                os.remove(hydrated.path)
+            except OSError as error:
+                if error.errno != errno.ENOENT:
+                    logging.warning("unable to evict %s: %s" % (hydrated.path, error))
+
+    def copyTo(self, record, destination):
+        """Copies a complete hydrated copy of record to destination, returning False if there isn't one"""
+        with self.lock:
+            hydrated = self.files.get(self._key(record))
+            if hydrated is None or hydrated.job is not None:
+                return False
+            hydrated.users += 1
+        try:
+            with open(hydrated.path, 'rb') as source:
+                with open(destination, 'wb') as target:
+                    while True:
+                        data = source.read(1 << 20)
+                        if not data:
+                            break
+                        target.write(data)
+        finally:
+            self.release(hydrated)
+        return True
+
+    def stats(self):
+        with self.lock:
+            return {'files': len(self.files), 'bytes': self.totalBytes, 'hits': self.hits,
+                'fetches': self.fetches, 'evictions': self.evictions
+            }
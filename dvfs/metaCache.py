@@ -0,0 +1,266 @@
+"""
+    metaCache: An in-process cache of FUSE attributes, kept up to date by following the CouchDB changes feed
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import couchdbkit as ck
+
+from metaRecord import metaRecord
+from pathTrie import pathTrie
+
+
+class metaCache(object):
+    """A bounded LRU cache of getattr results (as metaRecords) with a time to live, held in a pathTrie
+        Also remembers paths that were recently found not to exist, so repeated probes don't hit the database
+    """
+    def __init__(self, maxSize=100000, ttl=30.0, missingSize=10000, missingTTL=2.0):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.trie = pathTrie()
+        self.entries = OrderedDict() #trieNode -> None for the nodes holding a record, least recently used first
+        self.idNodes = dict() #document id -> trieNode, so changes can be matched back to cached paths
+        self.missingSize = missingSize
+        self.missingTTL = missingTTL
+        self.missing = OrderedDict() #path -> expiry time, for paths that don't exist
+        self.missingChildren = dict() #parent path -> set of missing paths inside it
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.missingHits = 0
+        self.generation = 0 #Bumped on every invalidation, so lookups racing a change don't cache stale data
+
+    def get(self, path):
+        """Returns the cached metaRecord for path, or None if it isn't cached or has expired"""
+        with self.lock:
+            node = self.trie.lookup(path)
+            record = node.record if node is not None else None
+            if record is None or record.expiry < time.time():
+                if record is not None:
+                    self._remove(node)
+                self.misses += 1
+                return None
+            del self.entries[node]
+            self.entries[node] = None #Reinsert to mark it as the most recently used
+            self.hits += 1
+            return record
+
+    def put(self, path, record, generation=None):
+        """Stores the metaRecord of path, evicting the least recently used entry if full
+            If generation is given and anything was invalidated since then, the record may be stale and isn't stored
+        """
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            oldNode = self.idNodes.get(record.docId) if record.docId else None
+            if oldNode is not None and self.trie.path(oldNode) != path:
+                self._remove(oldNode) #Still cached under the path it had before a move
+            node = self.trie.insert(path)
+            if node.record is not None:
+                self.idNodes.pop(node.record.docId, None)
+                del self.entries[node]
+            if record.docId:
+                self.idNodes[record.docId] = node
+            record.expiry = time.time() + self.ttl
+            node.record = record
+            self.entries[node] = None
+            while len(self.entries) > self.maxSize:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def isMissing(self, path):
+        """Returns True if path was recently looked up and didn't exist"""
+        with self.lock:
+            expiry = self.missing.get(path)
+            if expiry is None:
+                return False
+            if expiry < time.time():
+                self._removeMissing(path)
+                return False
+            self.missingHits += 1
+            return True
+
+    def putMissing(self, path, generation=None):
+        """Remembers that path doesn't exist, for a short while"""
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._removeMissing(path)
+            self.missing[path] = time.time() + self.missingTTL
+            self.missingChildren.setdefault(os.path.dirname(path), set()).add(path)
+            while len(self.missing) > self.missingSize:
+                self._removeMissing(next(iter(self.missing)))
+
+    def evict(self, path):
+        """Removes path from the cache, if it's there, and forgets that it was missing"""
+        with self.lock:
+            self.generation += 1
+            self._removePath(path)
+            self._removeMissing(path)
+
+    def evictTree(self, path):
+        """Removes path and everything below it, after a folder was deleted"""
+        with self.lock:
+            self.generation += 1
+            self._removeTree(path)
+
+    def move(self, old, new):
+        """Moves what's cached at and below old to new, after a rename
+            Only the node of old is moved, the records below it don't depend on their paths
+        """
+        with self.lock:
+            self.generation += 1
+            self._removeTree(new)
+            self._removeMissing(old)
+            node = self.trie.lookup(old)
+            if node is not None:
+                self.trie.move(node, new)
+            #Their link counts are derived from what's inside them
+            self._removePath(os.path.dirname(old))
+            self._removePath(os.path.dirname(new))
+
+    def evictMissingIn(self, parent):
+        """Forgets every missing path inside the parent folder"""
+        with self.lock:
+            self.generation += 1
+            self._removeMissingIn(parent)
+
+    def clear(self):
+        """Empties the cache, used when changes may have been missed"""
+        with self.lock:
+            self.generation += 1
+            self.trie = pathTrie()
+            self.entries.clear()
+            self.idNodes.clear()
+            self.missing.clear()
+            self.missingChildren.clear()
+
+    def _remove(self, node):
+        """Removes the record of node without locking, the caller must hold the lock"""
+        if node.record is None:
+            return
+        self.idNodes.pop(node.record.docId, None)
+        del self.entries[node]
+        node.record = None
+        self.trie.prune(node)
+
+    def _removePath(self, path):
+        node = self.trie.lookup(path)
+        if node is not None:
+            self._remove(node)
+
+    def _removeTree(self, path):
+        """Removes path and everything below it without locking"""
+        prefix = path.rstrip('/') + '/'
+        node = self.trie.lookup(path)
+        if node is not None:
+            for child in list(self.trie.walk(node)):
+                if child.record is not None:
+                    self.idNodes.pop(child.record.docId, None)
+                    del self.entries[child]
+                    child.record = None
+            node.children = None
+            self.trie.prune(node)
+        for missingPath in [missingPath for missingPath in self.missing if missingPath.startswith(prefix)]:
+            self._removeMissing(missingPath)
+        self._removeMissing(path)
+
+    def _removeMissing(self, path):
+        """Removes path from the missing entries without locking"""
+        if self.missing.pop(path, None) is None:
+            return
+        parent = os.path.dirname(path)
+        siblings = self.missingChildren.get(parent)
+        if siblings is not None:
+            siblings.discard(path)
+            if not siblings:
+                del self.missingChildren[parent]
+
+    def _removeMissingIn(self, parent):
+        """Removes every missing entry inside parent without locking"""
+        for path in self.missingChildren.pop(parent, ()):
+            self.missing.pop(path, None)
+
+    def applyChange(self, change):
+        """Evicts or refreshes the entry touched by a row of the changes feed"""
+        docId = change.get('id')
+        doc = change.get('doc') or {}
+        with self.lock:
+            self.generation += 1
+            oldNode = self.idNodes.get(docId)
+            if oldNode is not None:
+                parent = oldNode.parent
+                self._remove(oldNode)
+                if parent is not None:
+                    self._remove(parent) #Its link count is derived from what's inside it
+            if not change.get('deleted') and doc.get('path'):
+                #Something new may have appeared in the folder, so its misses can't be trusted anymore
+                self._removeMissingIn(os.path.dirname(doc['path']))
+                self._removePath(os.path.dirname(doc['path']))
+        if change.get('deleted') or doc.get('doc_type') != 'dbFile' or oldNode is None:
+            return #Folders are left for the next lookup, which counts their links
+        #The document was cached before, so refresh it rather than waiting for the next miss
+        try:
+            self.put(doc['path'], metaRecord.fromDoc(doc, docId))
+        except Exception:
+            logging.exception("unable to refresh cached metadata for %s" % docId)
+
+    def stats(self):
+        """Returns the cache counters, used for sizing the cache"""
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'maxSize': self.maxSize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'missingSize': len(self.missing),
+                'missingHits': self.missingHits,
+            }
+
+
+class changeFollower(threading.Thread):
+    """Follows the database's continuous changes feed, passing each change to the listeners"""
+    def __init__(self, database, listeners, since=None, heartbeat=30000):
+        super(changeFollower, self).__init__(name='dvfs-changes')
+        self.daemon = True
+        self.database = database
+        self.listeners = listeners
+        self.since = since
+        self.heartbeat = heartbeat
+        self.running = True
+
+    def run(self):
+        if self.since is None:
+            self.since = self.database.info()['update_seq']
+        consumer = ck.Consumer(self.database)
+        while self.running:
+            try:
+                consumer.wait(self._onChange,
+                    since=self.since,
+                    include_docs=True,
+                    heartbeat=self.heartbeat
+                )
+            except Exception:
+                if not self.running:
+                    break
+                logging.exception("lost the changes feed, reconnecting")
+                time.sleep(1) #The feed resumes from self.since, so nothing is missed
+
+    def _onChange(self, change):
+        if not self.running:
+            raise StopIteration()
+        if 'seq' in change:
+            self.since = change['seq']
+        if change.get('id', '').startswith('_design/'):
+            return
+        for listener in self.listeners:
+            listener.applyChange(change)
+
+    def stop(self):
+        self.running = False
@@ -0,0 +1,70 @@
+"""
+    metaRecord: The compact form of an object's attributes kept in the metadata cache
+    Records are built straight from the JSON CouchDB returns, without wrapping it in a couchdbkit Document, and hold
+    the times as epoch floats so getattr only has to copy a few slots into a dict. st_ino is derived from the
+    document id, so an object keeps its inode number across renames, restarts and nodes.
+"""
+
+import hashlib
+from stat import S_IFDIR, S_IFREG
+from time import mktime
+
+
+def epoch(value):
+    """Converts a couchdbkit DateTimeProperty ('YYYY-MM-DDTHH:MM:SSZ') to what mktime(datetime.timetuple()) gives"""
+    if not value:
+        return 0.0
+    return mktime((int(value[0:4]), int(value[5:7]), int(value[8:10]),
+        int(value[11:13]), int(value[14:16]), int(value[17:19]), 0, 0, -1
+    ))
+
+
+def inodeFor(docId):
+    """Returns the inode number of a document id, 60 bits of its hash (0 for no id, which getattr leaves out)"""
+    if not docId:
+        return 0
+    if isinstance(docId, unicode):
+        docId = docId.encode('utf-8')
+    return int(hashlib.md5(docId).hexdigest()[:15], 16) or 1
+
+
+class metaRecord(object):
+    """The FUSE attributes of one object, size is None for folders"""
+    __slots__ = ('docId', 'ino', 'mode', 'nlink', 'size', 'atime', 'mtime', 'ctime', 'expiry')
+
+    def __init__(self, docId, mode, nlink, size, atime, mtime, ctime):
+        self.docId = docId
+        self.ino = inodeFor(docId)
+        self.mode = mode
+        self.nlink = nlink
+        self.size = size
+        self.atime = atime
+        self.mtime = mtime
+        self.ctime = ctime
+        self.expiry = None
+
+    @classmethod
+    def fromDoc(cls, doc, docId=None):
+        """Builds the record of a dbFile or dbFolder document (or a dbObject-parent row value), as getAttributes would"""
+        docId = docId or doc.get('_id')
+        times = epoch(doc.get('accessTime')), epoch(doc.get('modifyTime')), epoch(doc.get('createTime'))
+        if doc['doc_type'] == 'dbFolder':
+            return cls(docId, S_IFDIR | 0755, doc.get('st_nlink') or 2, None, *times)
+        return cls(docId, S_IFREG | 0755, 1, doc.get('st_size') or 0, *times)
+
+    @classmethod
+    def fromAttributes(cls, attributes, docId=None):
+        return cls(docId, attributes['st_mode'], attributes.get('st_nlink'), attributes.get('st_size'),
+            attributes['st_atime'], attributes['st_mtime'], attributes['st_ctime']
+        )
+
+    def attributes(self):
+        """Returns a new getattr dict, which the caller may change"""
+        attributes = {'st_mode': self.mode, 'st_nlink': self.nlink,
+            'st_atime': self.atime, 'st_mtime': self.mtime, 'st_ctime': self.ctime
+        }
+        if self.size is not None:
+            attributes['st_size'] = self.size
+        if self.ino:
+            attributes['st_ino'] = self.ino
+        return attributes
@@ -0,0 +1,197 @@
+"""
+    metaSnapshot: A local sqlite copy of every object's attributes, so a fresh mount can answer lookups without CouchDB
+    The snapshot remembers the last changes feed sequence it applied, so after a restart only the changes made since
+    then have to be replayed.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from dbObjects import docClasses, iterView
+from metaRecord import metaRecord
+
+maxVariables = 500 #Parameters per statement, well below SQLITE_MAX_VARIABLE_NUMBER
+
+
+class metaSnapshot(object):
+    """Path keyed attributes stored in sqlite, kept up to date as a listener of the changes feed"""
+    def __init__(self, fileName, commitInterval=1.0):
+        self.fileName = fileName
+        self.commitInterval = commitInterval
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(fileName, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS objects (
+            path TEXT PRIMARY KEY, parent TEXT, name TEXT, docId TEXT, attributes TEXT
+        )''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS objectsParent ON objects (parent, name)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS objectsDocId ON objects (docId)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)')
+        self.connection.commit()
+        self.lastCommit = time.time()
+        self.loading = False
+        self.touched = set() #Documents the changes feed updated while loading, which the load mustn't overwrite
+        self.isComplete = bool(self._getState('complete'))
+
+    def _getState(self, key):
+        row = self.connection.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _setState(self, key, value):
+        self.connection.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+
+    @property
+    def since(self):
+        """The last changes feed sequence applied, or None if the snapshot was never loaded"""
+        with self.lock:
+            return self._getState('since')
+
+    @property
+    def complete(self):
+        """True once the snapshot holds every object, so folder listings can be served from it"""
+        return self.isComplete
+
+    def get(self, path):
+        """Returns (attributes, document id) for path, or None if it isn't in the snapshot"""
+        with self.lock:
+            row = self.connection.execute('SELECT attributes, docId FROM objects WHERE path = ?', (path,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def children(self, path):
+        """Returns a list of (name, attributes, document id) for everything directly inside path"""
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT name, attributes, docId FROM objects WHERE parent = ? ORDER BY name', (path,)
+            ).fetchall()
+        return [(name, json.loads(attributes), docId) for name, attributes, docId in rows]
+
+    def childCounts(self, paths):
+        """Returns {folder path: number of objects directly inside it}
+            Asked in batches of maxVariables paths, sqlite refuses statements with more than 999 parameters by default.
+        """
+        counts = dict((path, 0) for path in paths)
+        paths = list(counts)
+        for start in range(0, len(paths), maxVariables):
+            batch = paths[start:start + maxVariables]
+            with self.lock:
+                rows = self.connection.execute(
+                    'SELECT parent, count(*) FROM objects WHERE parent IN (%s) GROUP BY parent' % ','.join('?' * len(batch)),
+                    batch
+                ).fetchall()
+            counts.update(rows)
+        return counts
+
+    def put(self, path, attributes, docId):
+        with self.lock:
+            self._put(path, attributes, docId)
+            self._maybeCommit()
+
+    def remove(self, path):
+        with self.lock:
+            self.connection.execute('DELETE FROM objects WHERE path = ?', (path,))
+            self._maybeCommit()
+
+    def removeTree(self, path):
+        """Removes path and everything below it"""
+        prefix = path.rstrip('/') + '/'
+        with self.lock:
+            self.connection.execute('DELETE FROM objects WHERE path = ? OR substr(path, 1, ?) = ?',
+                (path, len(prefix), prefix)
+            )
+            self._maybeCommit()
+
+    def moveTree(self, old, new):
+        """Moves old and everything below it to new, replacing whatever was at new
+            Rows under new that the changes feed already wrote for moved documents are replaced by the same documents.
+        """
+        with self.lock:
+            self.connection.execute('DELETE FROM objects WHERE path = ?', (new,))
+            self.connection.execute('''UPDATE OR REPLACE objects SET path = ? || substr(path, ?),
+                parent = CASE WHEN path = ? THEN ? ELSE ? || substr(parent, ?) END,
+                name = CASE WHEN path = ? THEN ? ELSE name END
+                WHERE path = ? OR substr(path, 1, ?) = ?''',
+                (new, len(old) + 1, old, os.path.dirname(new), new, len(old) + 1, old, os.path.basename(new),
+                    old, len(old) + 1, old + '/'
+                )
+            )
+            self._maybeCommit()
+
+    def _put(self, path, attributes, docId):
+        self.connection.execute('DELETE FROM objects WHERE docId = ? AND path != ?', (docId, path))
+        self.connection.execute(
+            'INSERT OR REPLACE INTO objects (path, parent, name, docId, attributes) VALUES (?, ?, ?, ?, ?)',
+            (path, os.path.dirname(path), os.path.basename(path), docId, json.dumps(attributes))
+        )
+
+    def _maybeCommit(self):
+        if time.time() - self.lastCommit >= self.commitInterval:
+            self.connection.commit()
+            self.lastCommit = time.time()
+
+    def applyChange(self, change):
+        """Applies a row of the changes feed, recording its sequence along with it"""
+        docId = change.get('id')
+        doc = change.get('doc') or {}
+        with self.lock:
+            if self.loading:
+                self.touched.add(docId)
+            if change.get('deleted') or doc.get('doc_type') not in docClasses:
+                self.connection.execute('DELETE FROM objects WHERE docId = ?', (docId,))
+            else:
+                try:
+                    self._put(doc['path'], metaRecord.fromDoc(doc, docId).attributes(), docId)
+                except Exception:
+                    logging.exception("unable to store %s in the snapshot" % docId)
+            if 'seq' in change:
+                self._setState('since', change['seq'])
+            self._maybeCommit()
+
+    def clear(self):
+        """Forgets everything, the next mount loads the snapshot again"""
+        with self.lock:
+            self.connection.execute('DELETE FROM objects')
+            self.connection.execute('DELETE FROM state')
+            self.connection.commit()
+            self.isComplete = False
+
+    def load(self, database, since, pageSize=1000):
+        """Fills an empty snapshot with every object in the database
+            The changes feed should already be following from since, a sequence from before the load started.
+            Documents it reports during the load are newer than what the load read, so those are skipped here.
+            since is stored unless the feed already got further, so a snapshot loaded while nothing changed still
+            resumes from there on the next mount.
+        """
+        with self.lock:
+            self.loading = True
+            self.touched.clear()
+            if self._getState('since') is None:
+                self._setState('since', since)
+        try:
+            rows = iterView(database, 'dvfs/dbObject-all', '', {}, pageSize=pageSize, include_docs=True)
+            for row in rows:
+                doc = row['doc']
+                attributes = metaRecord.fromDoc(doc).attributes()
+                with self.lock:
+                    if doc['_id'] not in self.touched:
+                        self._put(doc['path'], attributes, doc['_id'])
+                    self._maybeCommit()
+            with self.lock:
+                self._setState('complete', True)
+                self.connection.commit()
+                self.isComplete = True
+        finally:
+            with self.lock:
+                self.loading = False
+                self.touched.clear()
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
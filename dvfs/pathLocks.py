@@ -0,0 +1,40 @@
+"""
+    pathLocks: Per path locks, so metadata changes to one path don't wait on changes to any other
+"""
+
+import threading
+from contextlib import contextmanager
+
+
+class pathLocks(object):
+    """Hands out a lock for each path, created when it's first needed and dropped once nobody holds or waits for it"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.locks = dict() #path -> [lock, number of threads holding or waiting for it]
+
+    @contextmanager
+    def hold(self, *paths):
+        """Holds the locks of all the paths, taken in sorted order so two callers can't deadlock"""
+        paths = sorted(set(paths))
+        entries = []
+        with self.lock:
+            for path in paths:
+                entry = self.locks.get(path)
+                if entry is None:
+                    entry = self.locks[path] = [threading.RLock(), 0]
+                entry[1] += 1
+                entries.append(entry)
+        acquired = []
+        try:
+            for entry in entries:
+                entry[0].acquire()
+                acquired.append(entry)
+            yield
+        finally:
+            for entry in reversed(acquired):
+                entry[0].release()
+            with self.lock:
+                for path, entry in zip(paths, entries):
+                    entry[1] -= 1
+                    if entry[1] == 0:
+                        del self.locks[path]
@@ -0,0 +1,87 @@
+"""
+    pathTrie: The cached part of the tree, one node per path component
+    Finding a path walks one node per component, everything below a folder hangs off its node, and moving a folder
+    moves only that node, so what's cached below it keeps working under the new path.
+"""
+
+
+class trieNode(object):
+    """One path component, holding the metaRecord cached for it (if any)"""
+    __slots__ = ('name', 'parent', 'children', 'record')
+
+    def __init__(self, name, parent):
+        self.name = name
+        self.parent = parent
+        self.children = None #name -> trieNode, only made once the node has children
+        self.record = None
+
+
+def _parts(path):
+    return [part for part in path.split('/') if part]
+
+
+class pathTrie(object):
+    """Nodes for the paths that have something cached, and the folders leading to them"""
+    def __init__(self):
+        self.root = trieNode(u'', None)
+
+    def lookup(self, path):
+        """Returns the node of path, or None if nothing is cached at or below it"""
+        node = self.root
+        for part in _parts(path):
+            if not node.children:
+                return None
+            node = node.children.get(part)
+            if node is None:
+                return None
+        return node
+
+    def insert(self, path):
+        """Returns the node of path, adding it and any missing folders on the way to it"""
+        node = self.root
+        for part in _parts(path):
+            if node.children is None:
+                node.children = dict()
+            child = node.children.get(part)
+            if child is None:
+                child = node.children[part] = trieNode(part, node)
+            node = child
+        return node
+
+    def path(self, node):
+        """Returns the current path of node, built from its parents"""
+        parts = []
+        while node.parent is not None:
+            parts.append(node.name)
+            node = node.parent
+        return '/' + '/'.join(reversed(parts))
+
+    def walk(self, node):
+        """Yields node and every node below it"""
+        nodes = [node]
+        while nodes:
+            node = nodes.pop()
+            yield node
+            if node.children:
+                nodes.extend(node.children.values())
+
+    def move(self, node, path):
+        """Moves node, and so everything below it, to path, replacing whatever node was there"""
+        parts = _parts(path)
+        parent = self.insert('/' + '/'.join(parts[:-1]))
+        oldParent = node.parent
+        del oldParent.children[node.name]
+        node.name = parts[-1]
+        node.parent = parent
+        if parent.children is None:
+            parent.children = dict()
+        parent.children[node.name] = node
+        self.prune(oldParent)
+
+    def prune(self, node):
+        """Removes node and then its parents, for as long as they hold nothing"""
+        while node.parent is not None and node.record is None and not node.children:
+            del node.parent.children[node.name]
+            if not node.parent.children:
+                node.parent.children = None
+            node = node.parent
@@ -0,0 +1,182 @@
+"""
+    readAhead: Notices handles being read sequentially and reads ahead of them on background threads
+    A handle's window starts at nothing, opens at minWindow once a few reads in a row follow each other and doubles
+    with every prefetch up to maxWindow. A read far from where the last one ended closes it again, so random access
+    costs nothing extra. Mostly useful for remote files, where a read ahead keeps the fetch of the next pieces going.
+"""
+
+import logging
+import threading
+from collections import deque
+
+sequentialReads = 2 #Reads in a row that follow each other before reading ahead starts
+
+
+class prefetchPool(object):
+    """Worker threads running the prefetches of every handle, and their combined stats"""
+    def __init__(self, workers=2, minWindow=1 << 17, maxWindow=1 << 23):
+        self.minWindow = minWindow
+        self.maxWindow = maxWindow
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.queue = deque()
+        self.running = True
+        self.hits = 0 #Reads answered from a read ahead buffer
+        self.misses = 0
+        self.prefetchedBytes = 0
+        self.threads = []
+        for number in range(workers):
+            thread = threading.Thread(target=self._work, name='dvfs-readahead-%d' % number)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, function, *args):
+        with self.lock:
+            if self.running:
+                self.queue.append((function, args))
+                self.ready.notify()
+                return True
+            return False
+
+    def _work(self):
+        while True:
+            with self.lock:
+                while self.running and not self.queue:
+                    self.ready.wait()
+                if not self.running:
+                    return
+                function, args = self.queue.popleft()
+            try:
+                function(*args)
+            except Exception:
+                logging.exception("read ahead failed")
+
+    def count(self, hit=False, prefetched=0):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            elif not prefetched:
+                self.misses += 1
+            self.prefetchedBytes += prefetched
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'prefetchedBytes': self.prefetchedBytes}
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+            self.ready.notify_all()
+
+
+class readAhead(object):
+    """The access pattern of one handle and the data read ahead of it, read with rawRead(size, offset)"""
+    def __init__(self, pool, rawRead):
+        self.pool = pool
+        self.rawRead = rawRead
+        self.lock = threading.Lock()
+        self.arrived = threading.Condition(self.lock)
+        self.expected = 0 #Where the next read starts if the handle is read sequentially, from the start at first
+        self.sequential = 0 #Reads in a row that followed each other
+        self.window = 0 #Bytes to keep read ahead of expected, 0 while the handle isn't read sequentially
+        self.blocks = deque() #Contiguous (offset, data) read ahead, the first one covering expected
+        self.inFlight = None #(offset, length) being read ahead
+        self.eof = False #True once the blocks reach the end of the file
+        self.generation = 0 #Changed by invalidate, so a prefetch started before a write is thrown away
+
+    def read(self, size, offset):
+        """Reads up to size bytes at offset, from the read ahead blocks when they cover them"""
+        with self.lock:
+            expected = self.expected
+            #Several fuse threads can deliver one sequential stream slightly out of order
+            if abs(offset - expected) <= max(2 * size, self.window):
+                self.sequential += 1
+                if self.sequential >= sequentialReads:
+                    self.window = max(self.window, self.pool.minWindow)
+                self.expected = max(expected, offset + size)
+            else:
+                self.sequential = 0
+                self.window = 0
+                self._drop()
+                self.expected = offset + size
+            while self.inFlight is not None and self.inFlight[0] <= offset < self.inFlight[0] + self.inFlight[1]:
+                self.arrived.wait()
+            data = self._fromBlocks(size, offset)
+            self._trim()
+            self._schedule()
+        self.pool.count(hit=data is not None)
+        if data is None:
+            data = self.rawRead(size, offset)
+        return data
+
+    def _fromBlocks(self, size, offset):
+        """Returns the bytes at offset from the blocks, None unless they hold all of them (or all up to the end)"""
+        if not self.blocks:
+            return None
+        start = self.blocks[0][0]
+        blockOffset, last = self.blocks[-1]
+        end = blockOffset + len(last)
+        if offset < start or (offset + size > end and not (self.eof and offset <= end)):
+            return None
+        parts = []
+        for blockOffset, block in self.blocks:
+            if blockOffset + len(block) <= offset:
+                continue
+            if blockOffset >= offset + size:
+                break
+            parts.append(block[max(offset - blockOffset, 0):offset + size - blockOffset])
+        return ''.join(parts)
+
+    def _trim(self):
+        """Drops the blocks entirely behind the reader"""
+        while self.blocks and self.blocks[0][0] + len(self.blocks[0][1]) <= self.expected:
+            self.blocks.popleft()
+
+    def _drop(self):
+        self.blocks.clear()
+        self.eof = False
+        self.generation += 1
+
+    def _schedule(self):
+        """Starts reading ahead when the blocks left in front of the reader fall below half the window"""
+        if not self.window or self.inFlight is not None or self.eof:
+            return
+        if self.blocks:
+            blockOffset, last = self.blocks[-1]
+            ahead = blockOffset + len(last)
+        else:
+            ahead = self.expected
+        buffered = ahead - self.expected
+        if buffered >= self.window // 2:
+            return
+        length = self.window - buffered
+        if self.pool.submit(self._prefetch, self.generation, ahead, length):
+            self.inFlight = (ahead, length)
+
+    def _prefetch(self, generation, offset, length):
+        try:
+            data = self.rawRead(length, offset)
+        except (IOError, OSError) as error:
+            logging.debug("unable to read ahead: %s" % error)
+            data = None #The reader hits the same error itself when it gets there
+        with self.lock:
+            self.inFlight = None
+            self.arrived.notify_all()
+            if data is None or generation != self.generation or not self.window:
+                return
+            if self.blocks:
+                blockOffset, last = self.blocks[-1]
+                if blockOffset + len(last) != offset:
+                    return
+            self.blocks.append((offset, data))
+            self.eof = len(data) < length
+            self.window = min(self.window * 2, self.pool.maxWindow) #It kept up, so read further ahead next time
+            self._trim()
+            self._schedule()
+        self.pool.count(prefetched=len(data))
+
+    def invalidate(self):
+        """Forgets what was read ahead, after the file was written or truncated"""
+        with self.lock:
+            self._drop()
@@ -0,0 +1,254 @@
+"""
+    reconcile: Brings the database in line with the base folder at startup, for changes made while dvfs wasn't running
+    Each top level folder is compared on its own thread. Its files are listed from disk and its documents are read
+    with one paged range query, and only the differences (by size, modification time and inode) are written.
+    Documents missing from disk are only deleted if this node holds them, the rest belong to files other nodes hold.
+    A file another node holds is only claimed when the local copy has the document's contents, anything else on disk
+    is a stale copy, and folders are never claimed since any node can fill them.
+"""
+
+import logging
+import os
+import stat
+import threading
+import time
+from Queue import Queue, Empty
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir #The backport, much faster than listdir and stat on large folders
+    except ImportError:
+        scandir = None
+
+from dbObjects import dbFile, dbFolder, iterView
+from fileHasher import hashFile, defaultAlgorithm
+
+
+class progress(object):
+    """Counts reconciled entries and estimates the time left, from the number of documents expected"""
+    def __init__(self, expected):
+        self.expected = expected
+        self.start = time.time()
+        self.lock = threading.Lock()
+        self.scanned = 0
+        self.created = 0
+        self.updated = 0
+        self.deleted = 0
+
+    def add(self, scanned=0, created=0, updated=0, deleted=0):
+        with self.lock:
+            self.scanned += scanned
+            self.created += created
+            self.updated += updated
+            self.deleted += deleted
+
+    def report(self):
+        with self.lock:
+            elapsed = time.time() - self.start
+            rate = self.scanned / elapsed if elapsed else 0.0
+            remaining = max(self.expected - self.scanned, 0)
+            eta = remaining / rate if rate else float('inf')
+            return "reconciled %d of ~%d entries (%.0f/s, ETA %.0fs): %d created, %d updated, %d deleted" % (
+                self.scanned, self.expected, rate, eta, self.created, self.updated, self.deleted
+            )
+
+
+class reconciler(object):
+    """Compares the base folder with its documents, queuing the differences on a bulkWriter"""
+    def __init__(self, base, database, writer, hashPool=None, algorithm=None, workers=4, pageSize=1000, node=None):
+        self.base = base.rstrip('/') if isinstance(base, unicode) else base.rstrip('/').decode('utf-8')
+        self.database = database
+        self.writer = writer
+        self.hashPool = hashPool
+        self.algorithm = algorithm
+        self.workers = workers
+        self.pageSize = pageSize
+        self.node = node
+        self.progress = progress(database.info().get('doc_count', 0))
+
+    def run(self, reportInterval=10):
+        """Reconciles the whole base folder, logging progress every reportInterval seconds"""
+        rootRows = self.database.view('dvfs/dbFolder-all', key='/').all()
+        if not rootRows:
+            root = dbFolder()
+            root.prepareNew('/')
+            self.writer.create(root)
+
+        #The top level goes first, so the folders exist before the threads start filling them
+        self._reconcile('/', False)
+        jobs = Queue()
+        for name, isDir, info in _listFolder(self.base):
+            if isDir:
+                jobs.put(('/' + name, True))
+
+        threads = []
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._work, args=(jobs,), name='dvfs-reconcile-%d' % number)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(reportInterval)
+                if thread.is_alive():
+                    break
+            logging.info(self.progress.report())
+        self.writer.flush()
+        logging.info("finished: " + self.progress.report())
+
+    def _work(self, jobs):
+        while True:
+            try:
+                path, recursive = jobs.get_nowait()
+            except Empty:
+                return
+            try:
+                self._reconcile(path, recursive)
+            except Exception:
+                logging.exception("unable to reconcile %s" % path)
+
+    def _reconcile(self, path, recursive):
+        """Reconciles what's inside path, everything below it when recursive or only its direct children when not"""
+        #The documents are read before the disk is scanned. Anything created in the meantime is then only seen on
+        #disk, where it gets a create, rather than only in the database, where it would get a delete
+        inDatabase = dict()
+        if recursive:
+            rows = iterView(self.database, 'dvfs/dbObject-all',
+                path + '/',
+                path + u'/\ufff0',
+                pageSize=self.pageSize,
+                include_docs=True
+            )
+        else:
+            rows = iterView(self.database, 'dvfs/dbObject-parent',
+                [path],
+                [path, {}],
+                pageSize=self.pageSize,
+                include_docs=True
+            )
+        for row in rows:
+            doc = row['doc']
+            inDatabase[doc['path']] = (doc['doc_type'], doc.get('st_size'), doc.get('baseMtime'), doc.get('baseIno'),
+                doc.get('node'), doc.get('fileHash'), doc.get('hashType')
+            )
+        onDisk = dict()
+        for childPath, isDir, info in self._scan(path, recursive):
+            onDisk[childPath] = (isDir, info)
+
+        #Creates are queued parents first, so a folder's document is always saved before its contents'
+        for childPath in sorted(onDisk, key=lambda childPath: childPath.count('/')):
+            isDir, info = onDisk[childPath]
+            existing = inDatabase.pop(childPath, None)
+            docType = 'dbFolder' if isDir else 'dbFile'
+            if existing is not None and existing[0] != docType:
+                self._delete(childPath)
+                if existing[0] == 'dbFolder' and not recursive:
+                    self._reconcile(childPath, True)
+                existing = None
+            if existing is None:
+                self._create(childPath, isDir)
+            elif isDir:
+                continue #Nothing to update, and never claimed
+            elif existing[4] not in (None, self.node):
+                if self._sameContents(childPath, info, existing):
+                    self._update(childPath) #Held by another node before, now held here
+            elif existing[1:4] != (info.st_size, info.st_mtime, info.st_ino):
+                self._update(childPath)
+        for childPath, existing in inDatabase.items():
+            if existing[4] not in (None, self.node):
+                continue #Held by another node, fetched from it when it's opened
+            if os.path.lexists(self.base + childPath):
+                continue #Created since the folder was scanned, the watcher or the FUSE process saves it
+            self._delete(childPath)
+            if existing[0] == 'dbFolder' and not recursive:
+                self._reconcile(childPath, True) #Gone from disk, so this only deletes what was inside it
+        self.progress.add(scanned=len(onDisk))
+
+    def _sameContents(self, path, info, existing):
+        """Returns True if the file at path has the contents of the document another node holds"""
+        size, fileHash, hashType = existing[1], existing[5], existing[6]
+        if fileHash is None or info.st_size != size:
+            return False
+        try:
+            return hashFile(self.base + path, hashType or defaultAlgorithm) == fileHash
+        except (IOError, OSError, ValueError):
+            return False
+
+    def _scan(self, path, recursive):
+        """Yields (dvfs path, is a folder, os.stat result) for the folders and regular files inside path"""
+        folders = [path]
+        while folders:
+            folder = folders.pop()
+            try:
+                children = list(_listFolder(self.base + folder.rstrip('/')))
+            except OSError:
+                continue #Removed while scanning, or a folder that only exists in the database
+            for name, isDir, info in children:
+                childPath = folder.rstrip('/') + '/' + name
+                yield childPath, isDir, info
+                if recursive and isDir:
+                    folders.append(childPath)
+
+    def _create(self, path, isDir):
+        basePath = self.base + path
+        if isDir:
+            info = dbFolder()
+            info.prepareNew(path)
+            info.node = self.node
+            self.writer.create(info)
+        else:
+            info = dbFile()
+            try:
+                info.prepareNew(path, basePath, algorithm=self.algorithm, hashLater=self.hashPool is not None)
+            except OSError:
+                return
+            info.node = self.node
+            onSaved = None
+            if self.hashPool:
+                onSaved = lambda record: self.hashPool.submit(record.path, basePath)
+            self.writer.create(info, onSaved)
+        self.progress.add(created=1)
+
+    def _update(self, path):
+        basePath = self.base + path
+        def change(record):
+            if not isinstance(record, dbFile):
+                return #Folders keep the node that made them
+            record.node = self.node
+            try:
+                if self.hashPool is None:
+                    record.updateHash(basePath, self.algorithm)
+                    return
+                record.recordStat(os.stat(basePath))
+                if record.hashOutdated(basePath, self.algorithm):
+                    self.hashPool.submit(record.path, basePath)
+            except OSError:
+                pass
+        self.writer.update(path, change)
+        self.progress.add(updated=1)
+
+    def _delete(self, path):
+        self.writer.delete(path)
+        self.progress.add(deleted=1)
+
+
+def _listFolder(fullPath):
+    """Yields (name, is a folder, os.stat result) for the folders and regular files directly inside fullPath"""
+    if scandir is not None:
+        for entry in scandir(fullPath):
+            try:
+                info = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            if stat.S_ISDIR(info.st_mode) or stat.S_ISREG(info.st_mode):
+                yield entry.name, stat.S_ISDIR(info.st_mode), info
+        return
+    for name in os.listdir(fullPath):
+        try:
+            info = os.lstat(os.path.join(fullPath, name))
+        except OSError:
+            continue
+        if stat.S_ISDIR(info.st_mode) or stat.S_ISREG(info.st_mode):
+            yield name, stat.S_ISDIR(info.st_mode), info
@@ -0,0 +1,131 @@
+"""
+    remoteChanges: Carries deletes and renames to the base folders of the other nodes
+    A file's contents only live in the base folder of the node holding it (and as stale copies in the base folders
+    of nodes that held it before), so deleting or renaming it from another node only changes its document. Each
+    such change is recorded as a dbRemoteChange document for every other node, which applies it to its own base
+    folder, from the changes feed while it's mounted or before reconciling when it mounts next. Otherwise its
+    reconcile would find the file still on disk and import it again.
+"""
+
+import errno
+import logging
+import os
+import threading
+import time
+
+import couchdbkit as ck
+
+from dbConnection import retrying
+
+
+class dbRemoteChange(ck.Document):
+    """A delete or rename made on origin, waiting to be applied to node's base folder"""
+    node = ck.StringProperty() #The node that applies it
+    origin = ck.StringProperty()
+    action = ck.StringProperty() #'delete' or 'rename'
+    changedPath = ck.StringProperty() #Not 'path', so the cache and the snapshot don't take it for a dbObject
+    newPath = ck.StringProperty()
+    time = ck.FloatProperty()
+
+
+def knownNodes(database):
+    """Returns the names of every node that has advertised itself, live or not"""
+    return set(row['key'] for row in database.view('dvfs/dbPeer-all'))
+
+def recordRemoteChange(database, nodes, origin, action, path, newPath=None):
+    """Records the change for each of the nodes other than origin"""
+    now = time.time()
+    changes = [dbRemoteChange(node=node, origin=origin, action=action, changedPath=path, newPath=newPath,
+        time=now
+    ).to_json() for node in sorted(set(nodes) - set([origin, None]))]
+    if changes:
+        retrying(lambda: database.bulk_save(changes))
+
+
+class remoteChangeApplier(object):
+    """Applies the changes recorded for node to its base folder
+        A change is skipped where this node has since made a new object at its path, and deleted once applied.
+        onApplied(action, path, newPath) is called after each change that touched the base folder.
+    """
+    def __init__(self, base, database, node, onApplied=None):
+        self.base = base.rstrip('/')
+        self.database = database
+        self.node = node
+        self.onApplied = onApplied
+        self.lock = threading.Lock()
+
+    def applyPending(self):
+        """Applies every change waiting for this node, oldest first"""
+        rows = self.database.view('dvfs/dbRemoteChange-node',
+            startkey=[self.node],
+            endkey=[self.node, {}],
+            include_docs=True
+        )
+        for row in rows:
+            self._apply(row['doc'])
+
+    def applyChange(self, change):
+        """Applies a change recorded for this node as it arrives on the changes feed"""
+        doc = change.get('doc') or {}
+        if change.get('deleted') or doc.get('doc_type') != 'dbRemoteChange' or doc.get('node') != self.node:
+            return
+        try:
+            self._apply(doc)
+        except Exception:
+            logging.exception("unable to apply the remote change %s" % change.get('id'))
+
+    def _apply(self, doc):
+        with self.lock:
+            path = doc['changedPath']
+            newPath = doc.get('newPath')
+            applied = False
+            if self._heldHere(path):
+                logging.info("not applying %s of %s from %s, it was made again here" % (doc['action'], path, doc['origin']))
+            elif doc['action'] == 'delete':
+                applied = self._delete(path)
+            elif doc['action'] == 'rename':
+                applied = self._rename(path, newPath)
+            try:
+                self.database.delete_doc(doc)
+            except (ck.ResourceNotFound, ck.ResourceConflict):
+                pass #Applied by an earlier run, or read from both the view and the feed
+        if applied and self.onApplied:
+            self.onApplied(doc['action'], path, newPath)
+
+    def _heldHere(self, path):
+        """Returns True if this node holds the document now at path"""
+        rows = self.database.view('dvfs/dbObject-all', key=path, include_docs=True).all()
+        return any(row['doc'].get('node') == self.node for row in rows)
+
+    def _delete(self, path):
+        fullPath = self.base + path
+        try:
+            if os.path.isdir(fullPath) and not os.path.islink(fullPath):
+                os.rmdir(fullPath)
+            else:
+                os.remove(fullPath)
+        except OSError as error:
+            if error.errno == errno.ENOTEMPTY:
+                logging.warning("not removing %s, it still holds files that aren't in the database" % fullPath)
+            elif error.errno != errno.ENOENT:
+                raise
+            return False
+        return True
+
+    def _rename(self, path, newPath):
+        """Renames like the origin did, replacing a file or an empty folder at newPath"""
+        fullOldPath = self.base + path
+        fullNewPath = self.base + newPath
+        if not os.path.lexists(fullOldPath):
+            return False
+        parent = os.path.dirname(fullNewPath)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        try:
+            os.rename(fullOldPath, fullNewPath)
+        except OSError as error:
+            if error.errno not in (errno.ENOTEMPTY, errno.EEXIST, errno.EISDIR, errno.ENOTDIR):
+                raise
+            logging.warning("not renaming %s, %s is in the way" % (fullOldPath, fullNewPath))
+            return False
+        return True
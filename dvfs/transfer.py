@@ -0,0 +1,558 @@
+"""
+    transfer: Moves file contents between dvfs nodes
+    Every node serves its chunks, and ranges of its base files, over HTTP and advertises itself with a dbPeer
+    document. A file whose metadata is in the database but whose contents aren't in the local base folder is
+    fetched from the live peers, several chunks at a time from several peers at once. Each chunk is checked against
+    its hash and the whole file against fileHash. A fetchJob can be read while it runs, the pieces a reader waits on
+    are fetched next.
+"""
+
+import errno
+import hashlib
+import hmac
+import httplib
+import logging
+import os
+import shutil
+import socket
+import threading
+import time
+import urllib
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+import couchdbkit as ck
+
+from dbConnection import getPipeline, retrying
+from dbObjects import loadChunkList
+from fileHasher import hashFile, defaultAlgorithm
+
+rangeSize = 1 << 20 #Bytes per request when a file has no chunk list to fetch by
+
+
+class dbPeer(ck.Document):
+    """A node's transfer server, kept fresh while the node is running"""
+    name = ck.StringProperty()
+    url = ck.StringProperty()
+    lastSeen = ck.FloatProperty()
+
+
+authHeader = 'X-Dvfs-Auth' #HMAC of the request's method and path with transferSecret
+
+
+def _sign(secret, method, path):
+    if isinstance(secret, unicode):
+        secret = secret.encode('utf-8')
+    return hmac.new(secret, '%s %s' % (method, path), hashlib.sha256).hexdigest()
+
+def _equal(given, expected):
+    """Compares two signatures in constant time"""
+    compare = getattr(hmac, 'compare_digest', None)
+    if compare is not None:
+        return compare(given, expected)
+    return len(given) == len(expected) and sum(ord(a) ^ ord(b) for a, b in zip(given, expected)) == 0
+
+def _validHash(chunkHash):
+    return len(chunkHash) >= 32 and all(character in '0123456789abcdef' for character in chunkHash)
+
+def _insideBase(base, path):
+    """Returns the full path of the dvfs path inside base, or None if it would point outside of it"""
+    base = os.path.realpath(base)
+    fullPath = os.path.realpath(base + '/' + path.lstrip('/'))
+    return fullPath if fullPath.startswith(base + '/') else None
+
+
+class _threadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _chunkHandler(BaseHTTPRequestHandler):
+    """GET /chunk/<hash>, GET /range?path=&offset=&length= and POST /have (newline separated hashes)
+        Every request must be signed with the shared transferSecret, ranges are only served of files this node holds.
+    """
+    protocol_version = 'HTTP/1.1' #Keep-alive, so a fetching peer reuses its connection
+
+    def _authorized(self):
+        secret = self.server.secret
+        return bool(secret) and _equal(self.headers.get(authHeader, ''), _sign(secret, self.command, self.path))
+
+    def do_GET(self):
+        if not self._authorized():
+            return self._send(403, '')
+        url = urlparse.urlparse(self.path)
+        if url.path.startswith('/chunk/'):
+            self._sendChunk(url.path[len('/chunk/'):])
+        elif url.path == '/range':
+            query = urlparse.parse_qs(url.query)
+            try:
+                path = query['path'][0]
+                offset = int(query['offset'][0])
+                length = min(int(query['length'][0]), rangeSize)
+            except (KeyError, ValueError):
+                return self._send(400, '')
+            self._sendRange(path, offset, length)
+        else:
+            self._send(404, '')
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        if not self._authorized():
+            return self._send(403, '')
+        if self.path != '/have':
+            return self._send(404, '')
+        store = self.server.store
+        present = [chunkHash for chunkHash in body.split() if store and _validHash(chunkHash) and store.has(chunkHash)]
+        self._send(200, '\n'.join(present))
+
+    def _sendChunk(self, chunkHash):
+        store = self.server.store
+        if store is None or not _validHash(chunkHash):
+            return self._send(404, '')
+        try:
+            data = store.get(chunkHash)
+        except IOError:
+            return self._send(404, '')
+        self._send(200, data)
+
+    def _sendRange(self, path, offset, length):
+        fullPath = _insideBase(self.server.base, path)
+        if fullPath is None:
+            return self._send(403, '')
+        try:
+            key = path.decode('utf-8')
+        except UnicodeDecodeError:
+            return self._send(400, '')
+        rows = self.server.database.view('dvfs/dbFile-all', key=key, include_docs=True).all()
+        if not rows or rows[0]['doc'].get('node') != self.server.node:
+            return self._send(404, '') #Not a file, or one another node holds and may be changing
+        try:
+            with open(fullPath, 'rb') as baseFile:
+                baseFile.seek(offset)
+                data = baseFile.read(length)
+        except IOError:
+            return self._send(404, '')
+        self._send(200, data)
+
+    def _send(self, status, data):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logging.debug("transfer server: " + format % args)
+
+
+class chunkServer(object):
+    """Serves this node's chunks and the ranges of the base files it holds to peers that know secret"""
+    def __init__(self, store, base, database, node, secret, host='127.0.0.1', port=0):
+        self.server = _threadingServer((host, port), _chunkHandler)
+        self.server.store = store
+        self.server.base = base
+        self.server.database = database
+        self.server.node = node
+        self.server.secret = secret
+        advertised = host if host not in ('', '0.0.0.0') else socket.getfqdn()
+        self.url = 'http://%s:%d' % (advertised, self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever, name='dvfs-transfer-server')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class peerRegistry(threading.Thread):
+    """Keeps this node's dbPeer document fresh and lists the other peers that are"""
+    def __init__(self, database, name, url, ttl=60.0):
+        super(peerRegistry, self).__init__(name='dvfs-peers')
+        self.daemon = True
+        self.database = database
+        self.name = name
+        self.url = url
+        self.ttl = ttl
+        self.stopped = threading.Event()
+
+    def run(self):
+        while True:
+            try:
+                self.announce()
+            except Exception:
+                logging.exception("unable to announce this node to its peers")
+            if self.stopped.wait(self.ttl / 3.0):
+                return
+
+    def announce(self):
+        def save():
+            rows = self.database.view('dvfs/dbPeer-all', key=self.name, include_docs=True).all()
+            peer = dbPeer.wrap(rows[0]['doc']) if rows else dbPeer(name=self.name)
+            peer.set_db(self.database)
+            peer.url = self.url
+            peer.lastSeen = time.time()
+            peer.save()
+        retrying(save)
+
+    def peers(self):
+        """Returns the urls of the other peers seen within the last ttl seconds"""
+        return list(self.urls().values())
+
+    def urls(self):
+        """Returns {node name: url} of the other peers seen within the last ttl seconds"""
+        cutoff = time.time() - self.ttl
+        return dict((row['key'], row['value']['url']) for row in self.database.view('dvfs/dbPeer-all')
+            if row['key'] != self.name and row['value']['lastSeen'] >= cutoff
+        )
+
+    def stop(self):
+        self.stopped.set()
+
+
+class _fetchState(object):
+    """The pieces of one file still to fetch, handed out to the peer workers
+        A piece is only given to a peer that has it and hasn't failed it yet. Workers wait while the only pieces
+        left for them are in progress elsewhere, since those may still fail and come back.
+    """
+    def __init__(self, pieces, availability):
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.pending = list(pieces) #Piece keys, in the order they're fetched
+        self.availability = availability #peer -> set of keys it has, or None if it may have any
+        self.active = set()
+        self.failed = dict() #key -> peers that failed it
+
+    def _possible(self, peer, key):
+        available = self.availability.get(peer)
+        return (available is None or key in available) and peer not in self.failed.get(key, ())
+
+    def take(self, peer):
+        """Returns the next key for peer to fetch, or None once there's nothing left it could fetch"""
+        with self.lock:
+            while True:
+                possible = [key for key in self.pending if self._possible(peer, key)]
+                if not possible:
+                    return None
+                for key in possible:
+                    if key not in self.active:
+                        self.active.add(key)
+                        return key
+                self.changed.wait()
+
+    def prioritize(self, keys):
+        """Moves keys to the front of the queue, for pieces a reader is waiting on"""
+        with self.lock:
+            keys = [key for key in keys if key in self.pending]
+            if keys:
+                wanted = set(keys)
+                self.pending = keys + [key for key in self.pending if key not in wanted]
+
+    def done(self, key):
+        with self.lock:
+            self.active.discard(key)
+            self.pending.remove(key)
+            self.changed.notify_all()
+
+    def fail(self, key, peer):
+        with self.lock:
+            self.active.discard(key)
+            self.failed.setdefault(key, set()).add(peer)
+            self.changed.notify_all()
+
+
+class fetchJob(object):
+    """One file being fetched in the background into partial, each part readable as soon as it's written
+        onFinished(job) is called from the job's thread once it succeeded or failed (job.error says which).
+    """
+    def __init__(self, engine, record, partial, keepChunks=True, onFinished=None):
+        self.engine = engine
+        self.record = record
+        self.partial = partial
+        self.size = record.st_size or 0
+        self.keepChunks = keepChunks #Add fetched chunks to the chunk store, so they can be passed on
+        self.onFinished = onFinished
+        self.lock = threading.Lock()
+        self.written = threading.Condition(self.lock)
+        self.ranges = [] #Sorted, merged [start, end) ranges written so far
+        self.state = None
+        self.pieces = dict() #piece key -> [(offset, length)], to prioritize what readers wait on
+        self.finished = False
+        self.error = None
+        self.fd = os.open(partial, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+        os.ftruncate(self.fd, self.size)
+        self.thread = threading.Thread(target=self._run, name='dvfs-fetch-job')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        try:
+            try:
+                self.engine._fetchInto(self)
+            finally:
+                os.close(self.fd)
+            self.engine._verify(self)
+        except Exception as error:
+            logging.error("unable to fetch %s: %s" % (self.record.path, error))
+            self.error = error if isinstance(error, (IOError, OSError)) else IOError(errno.EIO, str(error))
+        with self.lock:
+            self.finished = True
+            self.written.notify_all()
+        if self.onFinished is not None:
+            self.onFinished(self)
+
+    def write(self, offset, data):
+        """Writes a fetched piece into the partial file, waking any reader waiting for it"""
+        with self.lock:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            written = 0
+            while written < len(data):
+                written += os.write(self.fd, data[written:])
+            self._addRange(offset, offset + len(data))
+            self.written.notify_all()
+
+    def _addRange(self, start, end):
+        merged = []
+        for rangeStart, rangeEnd in self.ranges:
+            if rangeEnd < start or end < rangeStart:
+                merged.append((rangeStart, rangeEnd))
+            else:
+                start, end = min(start, rangeStart), max(end, rangeEnd)
+        merged.append((start, end))
+        merged.sort()
+        self.ranges = merged
+
+    def _covered(self, start, end):
+        return any(rangeStart <= start and end <= rangeEnd for rangeStart, rangeEnd in self.ranges)
+
+    def waitFor(self, offset, length):
+        """Blocks until the bytes from offset to offset + length (within the file) are written
+            Raises IOError if the fetch failed before they were
+        """
+        end = min(offset + length, self.size)
+        if offset >= end:
+            return
+        state = self.state
+        if state is not None:
+            state.prioritize([key for key, spans in self.pieces.items()
+                if any(start < end and offset < start + size for start, size in spans)
+            ])
+        with self.lock:
+            while not self._covered(offset, end):
+                if self.finished:
+                    raise self.error or IOError(errno.EIO, "%s wasn't fetched completely" % self.record.path)
+                self.written.wait()
+            if self.finished and self.error is not None:
+                raise self.error
+
+    def wait(self):
+        """Waits for the whole file, raising the error if it couldn't be fetched"""
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+class transferEngine(object):
+    """Fetches the contents of files from the peers listed by a peerRegistry"""
+    def __init__(self, registry, secret, store=None, partialPath=None, workers=4, timeout=30.0):
+        self.registry = registry
+        self.secret = secret
+        self.store = store
+        self.partialPath = partialPath
+        self.workers = workers
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.fetchedBytes = 0
+        self.localBytes = 0 #Bytes copied out of the local chunk store rather than fetched
+
+    def start(self, record, partial=None, keepChunks=True, onFinished=None):
+        """Starts fetching the contents of the dbFile record into partial in the background, returning the fetchJob"""
+        if partial is None:
+            partial = self.partialFor(record)
+        return fetchJob(self, record, partial, keepChunks, onFinished)
+
+    def fetch(self, record, destination):
+        """Fetches the contents of the dbFile record into destination, raising IOError if they can't be fetched
+            The file is assembled outside the base folder so the watcher only ever sees the finished file
+        """
+        job = self.start(record)
+        try:
+            job.wait()
+        except:
+            os.remove(job.partial)
+            raise
+        self.place(job.partial, destination)
+
+    def partialFor(self, record):
+        """Returns a path under partialPath to assemble record's contents in, unique to this thread"""
+        if not os.path.isdir(self.partialPath):
+            try:
+                os.makedirs(self.partialPath)
+            except OSError:
+                pass #Made by another thread in the meantime
+        return os.path.join(self.partialPath, '%s.%d.%d' % (record._id, os.getpid(), threading.current_thread().ident))
+
+    def place(self, partial, destination):
+        """Moves a finished file from partialPath into the base folder"""
+        folder = os.path.dirname(destination)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        try:
+            os.rename(partial, destination)
+        except OSError as error:
+            if error.errno != errno.EXDEV:
+                raise
+            shutil.move(partial, destination) #The partial folder is on another filesystem
+
+    def _fetchInto(self, job):
+        record = job.record
+        if not job.size:
+            return
+        urls = self.registry.urls()
+        chunks = None
+        if not record.chunksOutdated():
+            chunks = retrying(lambda: loadChunkList(self.registry.database, record.chunkHash))
+        if chunks:
+            self._fetchChunks(job, list(urls.values()), chunks)
+        else:
+            self._fetchRanges(job, [urls[record.node]] if record.node in urls else [])
+
+    def _verify(self, job):
+        record = job.record
+        if record.fileHash is None:
+            logging.warning("%s has no fileHash yet, its fetched contents couldn't be verified" % record.path)
+            return
+        if hashFile(job.partial, record.hashType or defaultAlgorithm) != record.fileHash:
+            raise IOError(errno.EIO, "the contents fetched for %s don't match its fileHash" % record.path)
+
+    def _fetchChunks(self, job, peers, chunks):
+        record = job.record
+        algorithm = record.hashType or defaultAlgorithm
+        offset = 0
+        for chunkHash, size in chunks: #A repeated chunk is fetched once and written everywhere it's used
+            job.pieces.setdefault(chunkHash, []).append((offset, size))
+            offset += size
+
+        missing = []
+        for chunkHash, spans in sorted(job.pieces.items(), key=lambda item: item[1][0][0]):
+            if self.store is not None and self.store.has(chunkHash):
+                data = self.store.get(chunkHash)
+                for offset, size in spans:
+                    job.write(offset, data)
+                with self.lock:
+                    self.localBytes += len(data) * len(spans)
+            else:
+                missing.append(chunkHash)
+        if not missing:
+            return
+        if not peers:
+            raise IOError(errno.EHOSTUNREACH, "no peers to fetch %s from" % record.path)
+
+        available = getPipeline().map(lambda peer: self._have(peer, missing), peers)
+        job.state = state = _fetchState(missing, dict(zip(peers, available)))
+        def fetchOne(connection, chunkHash):
+            data = _get(connection, '/chunk/' + chunkHash, self.secret)
+            spans = job.pieces[chunkHash]
+            if len(data) != spans[0][1] or hashlib.new(algorithm, data).hexdigest() != chunkHash:
+                raise IOError(errno.EIO, "chunk %s doesn't match its hash" % chunkHash)
+            for offset, size in spans:
+                job.write(offset, data)
+            if job.keepChunks and self.store is not None:
+                self.store.put(data)
+            return len(data) * len(spans)
+        self._run(state, peers, fetchOne)
+        if state.pending:
+            raise IOError(errno.EIO, "%d chunks of %s couldn't be fetched from any peer" % (len(state.pending), record.path))
+
+    def _fetchRanges(self, job, peers):
+        """Fetches a file without a current chunk list in fixed size ranges, from peers, the node holding it"""
+        record = job.record
+        if not peers:
+            raise IOError(errno.EHOSTUNREACH, "%s, the node holding %s, isn't reachable" % (record.node, record.path))
+        size = job.size
+        path = record.path.encode('utf-8') if isinstance(record.path, unicode) else record.path
+        for offset in range(0, size, rangeSize):
+            job.pieces[offset] = [(offset, min(rangeSize, size - offset))]
+        job.state = state = _fetchState(range(0, size, rangeSize), dict((peer, None) for peer in peers))
+        def fetchOne(connection, offset):
+            length = min(rangeSize, size - offset)
+            data = _get(connection, '/range?' + urllib.urlencode({'path': path, 'offset': offset, 'length': length}),
+                self.secret
+            )
+            if len(data) != length:
+                raise IOError(errno.EIO, "short range from a peer")
+            job.write(offset, data)
+            return length
+        self._run(state, peers, fetchOne)
+        if state.pending:
+            raise IOError(errno.EIO, "%d ranges of %s couldn't be fetched from any peer" % (len(state.pending), record.path))
+
+    def _have(self, peer, hashes):
+        """Returns the set of hashes peer has, or an empty set if it can't be asked"""
+        try:
+            connection = _connect(peer, self.timeout)
+            connection.request('POST', '/have', '\n'.join(hashes),
+                {'Content-Type': 'text/plain', authHeader: _sign(self.secret, 'POST', '/have')}
+            )
+            response = connection.getresponse()
+            body = response.read()
+            connection.close()
+            return set(body.split()) if response.status == 200 else set()
+        except (IOError, httplib.HTTPException, socket.error):
+            return set()
+
+    def _run(self, state, peers, fetchOne):
+        """Runs the workers, spread over the peers, until nothing's left that any of them could fetch"""
+        perPeer = max(1, self.workers // len(peers))
+        threads = []
+        for peer in peers:
+            for number in range(perPeer):
+                thread = threading.Thread(target=self._work, args=(peer, state, fetchOne), name='dvfs-fetch')
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+    def _work(self, peer, state, fetchOne):
+        connection = None
+        while True:
+            key = state.take(peer)
+            if key is None:
+                break
+            try:
+                if connection is None:
+                    connection = _connect(peer, self.timeout)
+                fetched = fetchOne(connection, key)
+            except (IOError, httplib.HTTPException, socket.error) as error:
+                logging.debug("fetching %s from %s failed: %s" % (key, peer, error))
+                state.fail(key, peer)
+                if connection is not None:
+                    connection.close()
+                connection = None #Its state is unknown after a failure
+                continue
+            state.done(key)
+            with self.lock:
+                self.fetchedBytes += fetched
+        if connection is not None:
+            connection.close()
+
+    def stats(self):
+        with self.lock:
+            return {'fetchedBytes': self.fetchedBytes, 'localBytes': self.localBytes}
+
+
+def _connect(peer, timeout):
+    url = urlparse.urlparse(peer)
+    return httplib.HTTPConnection(url.hostname, url.port or 80, timeout=timeout)
+
+def _get(connection, path, secret):
+    """Returns the body of a successful GET over a kept alive connection, raising IOError otherwise"""
+    connection.request('GET', path, headers={authHeader: _sign(secret, 'GET', path)})
+    response = connection.getresponse()
+    data = response.read()
+    if response.status != 200:
+        raise IOError(errno.ENOENT, "peer answered %d for %s" % (response.status, path))
+    return data
@@ -84,7 +84,7 @@ def delTestData():
 
         dbView = dbFile()
         dbView.set_db(database)
-        rmFile = dbView.view('dvfs/path-all', key=instance['path']).one() #There should only ever be one anyway
+        rmFile = dbView.view('dvfs/dbFile-all', key=instance['path'], include_docs=True).one() #There should only ever be one anyway
         rmFile.delete()
 
     print("Deleting test data")
@@ -100,3 +100,106 @@ def uploadViews():
     database = server.get_or_create_db(dbName)
     push('dvfs/_design/dvfs', database)
     print("Uploading views")
+
+def _loadDesign(path):
+    """Reads a design document folder (views/<name>/map.js and reduce.js) into a dictionary"""
+    import os
+    design = {'_id': '_design/' + os.path.basename(path), 'language': 'javascript', 'views': {}}
+    viewsPath = os.path.join(path, 'views')
+    for viewName in sorted(os.listdir(viewsPath)):
+        view = {}
+        for function in ('map', 'reduce'):
+            functionPath = os.path.join(viewsPath, viewName, function + '.js')
+            if os.path.exists(functionPath):
+                with open(functionPath) as functionFile:
+                    view[function] = functionFile.read()
+        design['views'][viewName] = view
+    return design
+
+@task
+def migrateViews():
+    """Upgrades the views of an existing database without blocking lookups while they rebuild
+        The new design document is indexed under a temporary name first. Once it's built it's copied over the
+        real one, which reuses the finished index since the view definitions are identical, and the old indexes
+        are cleaned up.
+    """
+    import time
+    import couchdbkit as ck #For an ORM'ish interface to couchDB
+    from configobj import ConfigObj
+    server = ck.Server()
+    dbName = ConfigObj('config.ini')['dbName']
+    database = server.get_or_create_db(dbName)
+
+    design = _loadDesign('dvfs/_design/dvfs')
+    staging = dict(design, _id='_design/dvfs-migrate')
+    if database.doc_exist(staging['_id']):
+        staging['_rev'] = database.get(staging['_id'])['_rev']
+    database.save_doc(staging)
+
+    print("Building the new indexes, this may take a while on large databases")
+    for viewName in sorted(staging['views']):
+        while True:
+            try:
+                database.view('dvfs-migrate/' + viewName, limit=1).all()
+                break
+            except Exception as error: #Usually a timeout while the index builds, just ask again
+                print("Still building %s (%s)" % (viewName, error))
+                time.sleep(5)
+
+    if database.doc_exist(design['_id']):
+        design['_rev'] = database.get(design['_id'])['_rev']
+    database.save_doc(design)
+    database.delete_doc(database.get(staging['_id']))
+    database.view_cleanup()
+    print("Migrated views")
+
+@task
+def multiNode(nodes=2, folder='multinode'):
+    """Mounts several dvfs nodes against the same database on this machine, until ctrl+c
+        Each node gets its own base folder, mount point and local state under folder/node<N>, and a config.ini
+        based on the shared one with its own nodeName and a transferSecret they share. Peers talk over loopback.
+    """
+    import os
+    import binascii
+    import subprocess
+    import time
+    from configobj import ConfigObj
+
+    shared = ConfigObj('config.ini')
+    secret = shared.get('transferSecret') or binascii.hexlify(os.urandom(16))
+    processes = []
+    mounts = []
+    for number in range(int(nodes)):
+        nodeFolder = os.path.abspath(os.path.join(folder, 'node%d' % number))
+        base = os.path.join(nodeFolder, 'base')
+        mount = os.path.join(nodeFolder, 'mount')
+        for path in (base, mount):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        config = ConfigObj('config.ini')
+        config.filename = os.path.join(nodeFolder, 'config.ini')
+        config['nodeName'] = 'node%d' % number
+        config['transferSecret'] = secret
+        config['transferHost'] = '127.0.0.1'
+        config['transferPort'] = 0
+        for setting, name in (('snapshotPath', 'snapshot.sqlite'), ('partialPath', 'partial'),
+                ('hydratePath', 'hydrated'), ('chunkPath', 'chunks')):
+            config[setting] = os.path.join(nodeFolder, name)
+        config.write()
+        environment = dict(os.environ, DVFS_CONFIG=config.filename)
+        processes.append(subprocess.Popen(['python', 'dvfs/dvfs.py', '-f', base, mount], env=environment))
+        mounts.append(mount)
+        print("node%d: %s mounted on %s" % (number, base, mount))
+
+    try:
+        while all(process.poll() is None for process in processes):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for mount in mounts:
+            subprocess.call(['fusermount', '-u', mount])
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+            process.wait()
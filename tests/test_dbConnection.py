@@ -0,0 +1,100 @@
+"""
+    Drives getDatabase against a stub CouchDB, so the retrying resource is exercised through the real couchdbkit stack
+"""
+
+import json
+import os
+import sys
+import threading
+import unittest
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'dvfs'))
+
+import dbConnection
+from dvfsConfig import defaults
+
+
+class _stubCouch(BaseHTTPRequestHandler):
+    """Knows one database, which only exists once it has been PUT"""
+    protocol_version = 'HTTP/1.1'
+    created = set()
+    requests = []
+    failures = 0 #GETs answered with a 503 before answering properly
+
+    def _answer(self, status, body):
+        data = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.requests.append(('GET', self.path))
+        if _stubCouch.failures:
+            _stubCouch.failures -= 1
+            return self._answer(503, {'error': 'unavailable', 'reason': 'try again'})
+        name = self.path.split('?')[0].strip('/')
+        if name in self.created:
+            return self._answer(200, {'db_name': name, 'doc_count': 0, 'update_seq': 0})
+        self._answer(404, {'error': 'not_found', 'reason': 'no_db_file'})
+
+    do_HEAD = do_GET
+
+    def do_PUT(self):
+        self.requests.append(('PUT', self.path))
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.created.add(self.path.split('?')[0].strip('/'))
+        self._answer(201, {'ok': True})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _threadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True #The pool keeps its connections alive
+
+
+class getDatabaseTests(unittest.TestCase):
+    def setUp(self):
+        _stubCouch.created = set()
+        _stubCouch.requests = []
+        _stubCouch.failures = 0
+        self.server = _threadingServer(('127.0.0.1', 0), _stubCouch)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.config = dict(defaults, couchUrl='http://127.0.0.1:%d' % self.server.server_address[1], dbBackoff=0.0)
+        dbConnection._servers.clear()
+        dbConnection._databases.clear()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_createsMissingDatabase(self):
+        database = dbConnection.getDatabase('dvfs', self.config)
+        self.assertEqual(database.info()['db_name'], 'dvfs')
+        self.assertIn('PUT', [method for method, path in _stubCouch.requests])
+
+    def test_reusesHandle(self):
+        self.assertIs(dbConnection.getDatabase('dvfs', self.config), dbConnection.getDatabase('dvfs', self.config))
+
+    def test_retriesServerErrorsOnReads(self):
+        database = dbConnection.getDatabase('dvfs', self.config)
+        _stubCouch.failures = 2
+        self.assertEqual(database.info()['db_name'], 'dvfs')
+
+    def test_passesQueryParameters(self):
+        dbConnection.getDatabase('dvfs', self.config)
+        resource = dbConnection.getServer(self.config).res
+        resource.get('/dvfs', params_dict={'limit': 1}, descending=True)
+        path = _stubCouch.requests[-1][1]
+        self.assertIn('limit=1', path)
+        self.assertIn('descending=true', path)
+
+
+if __name__ == '__main__':
+    unittest.main()